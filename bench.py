@@ -0,0 +1,141 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# bench - Benchmark the DL-120TH download against an emulated logger
+#
+# Copyright 2015 Patrick Rabu
+
+import argparse
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from timeit import default_timer as timer
+
+from dl120emu import Dl120thEmulator
+
+PHASES = ('config', 'data', 'save', 'total')
+
+
+def load_dl120th():
+    """ Load dl-120th.py as a module (its file name is not importable). """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'dl-120th.py')
+    return imp.load_source('dl120th', path)
+
+
+class Quiet:
+    """ Swallow the progress output of Dl120th while timing. """
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def run(dl120th, num_data, fn, pipeline=False, faults=0):
+    """
+    Download num_data samples from an emulated logger and save them in fn,
+    faults transfer failures being spread over the download.
+    Return the duration in seconds of each phase (with pipeline, the
+    download and the save overlap and are counted as data) and the number
+    of retries.
+    """
+    device = Dl120thEmulator.synthetic(num_data)
+    packets = -(-num_data // 16)
+    device.faults = set(packets * (i + 1) // (faults + 1)
+                        for i in range(faults))
+    logger = dl120th.Dl120th(device, backoff=0)
+    stdout = sys.stdout
+    sys.stdout = Quiet()
+    try:
+        t0 = timer()
+        logger.open()
+        logger.read_config()
+        t1 = timer()
+        if pipeline:
+            logger.download([dl120th.DatSink(fn, logger)])
+            t2 = timer()
+        else:
+            logger.read_data()
+            t2 = timer()
+            logger.save_data_to_file(fn)
+        t3 = timer()
+        logger.close()
+    finally:
+        sys.stdout = stdout
+
+    return {'config': t1 - t0, 'data': t2 - t1, 'save': t3 - t2,
+            'total': t3 - t0, 'retries': logger.retry_count}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark read_config + read_data + save '
+        'against an emulated DL-120TH.',
+        prog='bench.py')
+    parser.add_argument(
+        '-n', '--numdata',
+        help='Number of data to download (between 50 and 16000), '
+        'can be repeated.',
+        type=int, action='append')
+    parser.add_argument(
+        '-r', '--repeat',
+        help='Number of runs per size, the best one is kept.',
+        type=int, default=5)
+    parser.add_argument(
+        '-j', '--json',
+        help='Print one JSON line per size instead of a table.',
+        action='store_true')
+    parser.add_argument(
+        '-p', '--pipeline',
+        help='Save the data while they are downloaded.',
+        action='store_true')
+    parser.add_argument(
+        '-f', '--faults',
+        help='Number of transfer failures injected in each download '
+        '(the download is resumed without delay).',
+        type=int, default=0)
+
+    args = parser.parse_args()
+
+    sizes = args.numdata or [50, 1000, 4000, 16000]
+    dl120th = load_dl120th()
+    workdir = tempfile.mkdtemp(prefix='dl120bench')
+
+    if not args.json:
+        print("%8s %10s %10s %10s %10s %12s %8s" % (
+            'numdata', 'config ms', 'data ms', 'save ms', 'total ms',
+            'samples/s', 'retries'))
+    try:
+        for num_data in sizes:
+            best = None
+            for i in range(args.repeat):
+                timings = run(dl120th, num_data,
+                              os.path.join(workdir, 'bench.dat'),
+                              args.pipeline, args.faults)
+                if best is None:
+                    best = timings
+                else:
+                    for phase in PHASES:
+                        best[phase] = min(best[phase], timings[phase])
+
+            rate = num_data / best['total']
+            if args.json:
+                result = dict(best)
+                result['numdata'] = num_data
+                result['samples_per_sec'] = rate
+                print(json.dumps(result, sort_keys=True))
+            else:
+                print("%8i %10.2f %10.2f %10.2f %10.2f %12.0f %8i" % (
+                    num_data, best['config'] * 1000, best['data'] * 1000,
+                    best['save'] * 1000, best['total'] * 1000, rate,
+                    best['retries']))
+    finally:
+        shutil.rmtree(workdir)
+
+    sys.exit(0)
@@ -6,31 +6,273 @@
 # Copyright 2012, 2015 Patrick Rabu
 
 import argparse
+import glob
+import os
 import sys
-import sqlite3
+import time
+
+from array import array
+from datetime import datetime
+from itertools import chain, islice
+from multiprocessing import Pool
+from timeit import default_timer as timer
+
+import dlformats
+import sensorsdb
+
+
+def read_header(datfile):
+    """
+    Read the header line of an opened dat file:
+    "# name [YYYY-mm-dd HH:MM:SS] N points @ I sec"
+    Return the logger name and the interval.
+    """
+    words = datfile.readline().split()
+    return words[1], int(words[7])
+
+
+def file_start(fn):
+    """ Epoch of the start of the recording of a dat, bin or dla file. """
+    if dlformats.is_bin(fn):
+        return dlformats.load_bin(fn).start
+    if dlformats.is_dla(fn):
+        with dlformats.DlaReader(fn) as reader:
+            return reader.start
+    with open(fn) as datfile:
+        words = datfile.readline().split()
+    start = datetime.strptime(words[2] + " " + words[3],
+                              "[%Y-%m-%d %H:%M:%S]")
+    return int(time.mktime(start.timetuple()))
+
+
+def expand_files(patterns):
+    """
+    Files named by patterns: file names, glob patterns or directories
+    (their .dat, .bin and .dla files). Return the files sorted by the
+    start of their recording.
+    """
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.update(glob.glob(os.path.join(pattern, '*.dat')))
+            files.update(glob.glob(os.path.join(pattern, '*.bin')))
+            files.update(glob.glob(os.path.join(pattern, '*.dla')))
+        else:
+            files.update(glob.glob(pattern) or [pattern])
+    return sorted(files, key=lambda fn: (file_start(fn), fn))
+
+
+def read_rows(datfile, logger_name, interval, watermark=None):
+    """
+    Read the data lines following the header of an opened dat file.
+    The dt of the rows are start + i * interval, start being the timestamp
+    of the first line. The lines that are not after the watermark are
+    skipped without being parsed.
+    Return the number of skipped lines and a generator of the remaining
+    (logger, dt, temp, hygro) rows.
+    """
+    line = datfile.readline()
+    if not line:
+        return 0, iter(())
+
+    start = int(line.split()[0])
+    lines = chain([line], datfile)
+    skipped = sum(1 for line in islice(
+        lines, sensorsdb.skip_count(watermark, start, interval)))
+
+    def rows():
+        dt = start + skipped * interval
+        for line in lines:
+            words = line.split()
+            yield (logger_name, dt, words[3], words[4])
+            dt += interval
+
+    return skipped, rows()
+
+
+def parse_file(fn):
+    """
+    Parse a dat, bin or dla file in a worker process of the batch mode.
+    Return (fn, logger, start, interval, temp, hygro), temp and hygro
+    being arrays of floats (compact to send to the writer process).
+    """
+    if dlformats.is_bin(fn) or dlformats.is_dla(fn):
+        if dlformats.is_bin(fn):
+            recording = dlformats.load_bin(fn)
+        else:
+            recording = dlformats.load_dla(fn)
+        return (fn, recording.name, recording.start, recording.interval,
+                array('d', recording.temp.values()),
+                array('d', recording.rh.values()))
+
+    with open(fn) as datfile:
+        logger_name, interval = read_header(datfile)
+        start = None
+        temp = array('d')
+        hygro = array('d')
+        for line in datfile:
+            words = line.split()
+            if start is None:
+                start = int(words[0])
+            temp.append(float(words[3]))
+            hygro.append(float(words[4]))
+    return fn, logger_name, start, interval, temp, hygro
+
+
+def import_file(conn, filename, batch_size, progress=None, quiet=False):
+    """
+    Insert a dat, bin or dla file in the database, the lines (or dla
+    blocks) that are not after the watermark of the logger being skipped
+    without being parsed (or decompressed).
+    Return the number of rows read and of new rows.
+    """
+    if dlformats.is_bin(filename):
+        recording = dlformats.load_bin(filename)
+        watermark = sensorsdb.get_watermark(conn, recording.name)
+        if not quiet:
+            print("Logger=", recording.name, " watermark=", watermark)
+        skipped, rows = sensorsdb.sample_rows(
+            recording.name, recording.start, recording.interval,
+            recording.temp.raw, recording.rh.raw, watermark)
+        count, new = sensorsdb.insert_rows(conn, rows, batch_size, progress)
+    elif dlformats.is_dla(filename):
+        with dlformats.DlaReader(filename) as reader:
+            watermark = sensorsdb.get_watermark(conn, reader.name)
+            if not quiet:
+                print("Logger=", reader.name, " watermark=", watermark)
+            skip = sensorsdb.skip_count(watermark, reader.start,
+                                        reader.interval)
+
+            def rows():
+                for first, temp, rh in reader.blocks(skip):
+                    block_skipped, block_rows = sensorsdb.sample_rows(
+                        reader.name, reader.start + first * reader.interval,
+                        reader.interval, temp, rh, watermark)
+                    for row in block_rows:
+                        yield row
+
+            count, new = sensorsdb.insert_rows(conn, rows(), batch_size,
+                                               progress)
+            skipped = min(reader.count, skip)
+    else:
+        with open(filename) as datfile:
+            logger_name, interval = read_header(datfile)
+            watermark = sensorsdb.get_watermark(conn, logger_name)
+            if not quiet:
+                print("Logger=", logger_name, " watermark=", watermark)
+            skipped, rows = read_rows(datfile, logger_name, interval,
+                                      watermark)
+            count, new = sensorsdb.insert_rows(conn, rows, batch_size,
+                                               progress)
+    return count + skipped, new
+
+
+def import_files(conn, files, batch_size, jobs=None, quiet=False):
+    """
+    Insert the files in the database in their order: they are parsed by a
+    pool of jobs processes and their rows inserted by this process only,
+    the samples that are not after the watermark of their logger being
+    skipped. Print the progress after each file unless quiet.
+    Return the number of rows read and of new rows.
+    """
+    total = 0
+    total_new = 0
+    start = timer()
+    pool = Pool(jobs)
+    try:
+        parsed = pool.imap(parse_file, files)
+        for i, (fn, logger_name, first, interval, temp, hygro) in \
+                enumerate(parsed):
+            skipped = 0
+            if first is not None:
+                watermark = sensorsdb.get_watermark(conn, logger_name)
+                skipped = min(len(temp), sensorsdb.skip_count(
+                    watermark, first, interval))
+
+            def rows():
+                dt = first + skipped * interval
+                for j in range(skipped, len(temp)):
+                    yield (logger_name, dt, temp[j], hygro[j])
+                    dt += interval
+
+            count, new = sensorsdb.insert_rows(conn, rows(), batch_size)
+            total += count + skipped
+            total_new += new
+            if not quiet:
+                duration = timer() - start
+                print("[%i/%i] %s: %s %i rows, %i new - %i rows in %.1f s "
+                      "(%.0f rows/s)" % (
+                          i + 1, len(files), fn, logger_name,
+                          count + skipped, new, total, duration,
+                          total / duration if duration > 0 else 0))
+    finally:
+        pool.close()
+        pool.join()
+    return total, total_new
+
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(
-        description='Insert content of dat file into sqlite DB.',
+        description='Insert content of dat (or bin or dla) file into '
+        'sqlite DB.',
         prog='dat2db.py', version='0.1')
     parser.add_argument(
-        '-f', '--filename', help='Name of the data file.')
+        '-f', '--filename',
+        help='Name of the data file, or glob pattern or directory (its '
+        '.dat, .bin and .dla files) to import several files, can be '
+        'repeated.',
+        action='append')
     parser.add_argument(
         '-d', '--database', help='Name of the database file.')
+    parser.add_argument(
+        '-b', '--batch-size', type=int, default=10000,
+        help='Number of rows inserted per transaction (default 10000).')
+    parser.add_argument(
+        '--journal-mode', choices=('DELETE', 'TRUNCATE', 'WAL', 'MEMORY'),
+        help='SQLite journal mode.')
+    parser.add_argument(
+        '--synchronous', choices=('OFF', 'NORMAL', 'FULL'),
+        help='SQLite synchronous mode.')
+    parser.add_argument(
+        '--cache-size', type=int,
+        help='SQLite page cache size in KiB.')
+    parser.add_argument(
+        '--fast', action='store_true',
+        help='Shortcut for --journal-mode WAL --synchronous NORMAL '
+        '--cache-size 65536.')
+    parser.add_argument(
+        '-p', '--progress', type=int,
+        help='Print the number of inserted rows every PROGRESS rows.')
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help='Only print the final report.')
+    parser.add_argument(
+        '--partition', choices=('month', 'year'),
+        help='Store the data in one database file per month or per year '
+        'next to the database (existing data are moved to them).')
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='Number of processes parsing the files when several files '
+        'are imported (default: number of CPUs).')
+    parser.add_argument(
+        '-r', '--rebuild-rollups', action='store_true',
+        help='Recompute the hourly and daily rollup tables from the '
+        'sensors table (no file is needed).')
 
     args = parser.parse_args()
 
-    print("Filename=", args.filename)
-    print("Database=", args.database)
+    if not args.quiet:
+        print("Filename=", args.filename)
+        print("Database=", args.database)
 
     commandOk = True
 
-    if args.filename is None:
+    if args.filename is None and not args.rebuild_rollups:
         print("Filename is mandatory.")
         commandOk = False
-    else:
-        filename = args.filename
+    elif args.filename is not None:
+        files = expand_files(args.filename)
 
     if args.database is None:
         print("DataBase name is mandatory.")
@@ -38,34 +280,47 @@ if __name__ == '__main__':
     else:
         dbname = args.database
 
+    if args.batch_size < 1:
+        print("Batch size should be greater than 0.")
+        commandOk = False
+
     if not commandOk:
         print("Command line error...")
         sys.exit(2)
 
-    conn = sqlite3.connect(dbname)
+    if args.fast:
+        args.journal_mode = args.journal_mode or 'WAL'
+        args.synchronous = args.synchronous or 'NORMAL'
+        args.cache_size = args.cache_size or 65536
 
-    c = conn.cursor()
-    c.execute(
-        '''CREATE TABLE IF NOT EXISTS
-        sensors (logger text, dt text, temp real, hygro real)''')
+    conn = sensorsdb.connect(dbname, args.partition)
+    sensorsdb.set_pragmas(conn, args.journal_mode, args.synchronous,
+                          args.cache_size)
 
-    with open(filename) as datfile:
-        # Read the first line
-        line = datfile.readline()
-        print(line)
-        words = line.split()
-        print(words[0], "-", words[1], "-", words[2],
-              "-", words[3], "-", words[4])
-        logger_name = words[1]
+    if args.rebuild_rollups:
+        start = timer()
+        sensorsdb.rebuild_rollups(conn)
+        print("Rollups rebuilt in %.3f s" % (timer() - start))
+        if args.filename is None:
+            conn.close()
+            sys.exit(0)
 
-        for line in datfile:
-            words = line.split()
-            print(words[0], "-", words[3], "-", words[4])
-            c.execute(
-                'INSERT INTO sensors VALUES (?, ?, ?, ?)',
-                (logger_name, words[0], words[3], words[4]))
+    start = timer()
+    if len(files) == 1 and not os.path.isdir(args.filename[0]):
+        count, new = import_file(conn, files[0], args.batch_size,
+                                 None if args.quiet else args.progress,
+                                 args.quiet)
+    else:
+        if not args.quiet:
+            print("Files=", len(files))
+        count, new = import_files(conn, files, args.batch_size, args.jobs,
+                                  args.quiet)
+    duration = timer() - start
 
-    conn.commit()
     conn.close()
 
-sys.exit(0)
+    print("%i rows read in %.3f s (%.0f rows/s): %i new, %i skipped" % (
+        count, duration, count / duration if duration > 0 else 0,
+        new, count - new))
+
+    sys.exit(0)
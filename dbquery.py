@@ -0,0 +1,423 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# dbquery - Statistics and export of the Voltcraft DL-120TH data stored
+# in the sensors database.
+#
+# Copyright 2015 Patrick Rabu
+
+import argparse
+import calendar
+import csv
+import json
+import sys
+import time
+
+from datetime import datetime
+from itertools import chain
+
+import numpy
+
+import dlalarms
+import sensorsdb
+
+# Buckets of the statistics (hours, days or months in local time)
+GRANULARITIES = ('all', 'hour', 'day', 'month')
+
+# Columns of the export
+EXPORT_FIELDS = ('logger', 'dt', 'date', 'temp', 'hygro')
+
+# Statistics of the buckets computed by SQLite, from the sensors table (or
+# partition) or from a rollup table (min, max and sum)
+STATS_FROM_SENSORS = '''SELECT b.start, count(*), min(temp), max(temp),
+    sum(temp), min(hygro), max(hygro), sum(hygro)
+    FROM buckets b JOIN %s s
+    ON s.logger = ? AND s.dt >= b.start AND s.dt < b.end
+    GROUP BY b.start'''
+
+STATS_FROM_ROLLUP = '''SELECT b.start, sum(count), min(temp_min),
+    max(temp_max), sum(temp_sum), min(hygro_min), max(hygro_max),
+    sum(hygro_sum)
+    FROM buckets b JOIN %s r
+    ON r.logger = ? AND r.dt >= b.start AND r.dt < b.end
+    GROUP BY b.start'''
+
+
+def parse_date(text):
+    """ Epoch of a local date YYYY-mm-dd or YYYY-mm-dd HH:MM:SS. """
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return int(time.mktime(datetime.strptime(text, fmt).timetuple()))
+        except ValueError:
+            pass
+    raise ValueError("Invalid date: %s" % text)
+
+
+def local_epoch(year, month):
+    """ Epoch of the first day of a month in local time. """
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return int(time.mktime((year, month, 1, 0, 0, 0, 0, 0, -1)))
+
+
+def period_range(period):
+    """ Range [tmin, tmax[ of a month YYYYMM or of a year YYYY. """
+    year = int(period[0:4])
+    if len(period) == 4:
+        return local_epoch(year, 1), local_epoch(year + 1, 1)
+    month = int(period[4:6])
+    return local_epoch(year, month), local_epoch(year, month + 1)
+
+
+def next_edge(granularity, t):
+    """ Epoch of the start of the hour, day or month following t. """
+    tm = time.localtime(t)
+    if granularity == 'month':
+        return local_epoch(tm.tm_year, tm.tm_mon + 1)
+    if granularity == 'day':
+        return int(time.mktime((tm.tm_year, tm.tm_mon, tm.tm_mday + 1,
+                                0, 0, 0, 0, 0, -1)))
+    # The offset from UTC only changes at the start of an hour
+    wall = calendar.timegm(tm)
+    return t + 3600 - wall % 3600
+
+
+def bucket_edges(granularity, tmin, tmax):
+    """
+    Edges of the buckets of granularity (in local time) covering
+    [tmin, tmax[: the first and the last ones are cut at tmin and tmax.
+    """
+    edges = [tmin]
+    if granularity != 'all':
+        edge = next_edge(granularity, tmin)
+        while edge < tmax:
+            edges.append(edge)
+            edge = next_edge(granularity, edge)
+    edges.append(tmax)
+    return edges
+
+
+def create_buckets(conn, edges):
+    """ Temporary table of the buckets [start, end[ of the edges. """
+    conn.execute('''CREATE TEMP TABLE IF NOT EXISTS
+        buckets (start integer PRIMARY KEY, end integer)''')
+    conn.execute('BEGIN')
+    conn.execute('DELETE FROM buckets')
+    conn.executemany('INSERT INTO buckets VALUES (?, ?)',
+                     zip(edges[:-1], edges[1:]))
+    conn.execute('COMMIT')
+
+
+def sql_stats(conn, logger, edges):
+    """
+    Count, min, max and mean of the temperature and of the hygrometry of
+    the logger in each bucket, aggregated by indexed SQL queries on the
+    coarsest rollup table whose period divides the edges, or on the
+    sensors table (or each overlapping partition).
+    Return a list of (start, count, temp_min, temp_max, temp_mean,
+    hygro_min, hygro_max, hygro_mean).
+    """
+    source = None
+    for table, period in sensorsdb.ROLLUPS:
+        if all(edge % period == 0 for edge in edges):
+            source = table
+
+    # The partial results of the partitions are merged, each partition
+    # being queried while it is attached
+    buckets = {}
+
+    def merge(rows):
+        for row in rows:
+            start, count, tmin, tmax, tsum, hmin, hmax, hsum = row
+            if start in buckets:
+                prev = buckets[start]
+                count, tsum, hsum = (count + prev[1], tsum + prev[4],
+                                     hsum + prev[7])
+                tmin, tmax = min(tmin, prev[2]), max(tmax, prev[3])
+                hmin, hmax = min(hmin, prev[5]), max(hmax, prev[6])
+            buckets[start] = (start, count, tmin, tmax, tsum, hmin, hmax,
+                              hsum)
+
+    if source is None:
+        for sensors in sensorsdb.sensors_tables(conn, edges[0], edges[-1]):
+            merge(conn.execute(STATS_FROM_SENSORS % sensors, (logger, )))
+    else:
+        merge(conn.execute(STATS_FROM_ROLLUP % source, (logger, )))
+
+    return [(start, count, tmin, tmax, round(tsum / count, 3), hmin, hmax,
+             round(hsum / count, 3))
+            for start, count, tmin, tmax, tsum, hmin, hmax, hsum
+            in sorted(buckets.values())]
+
+
+def load_samples(conn, logger, tmin, tmax):
+    """
+    Dates, temperatures and hygrometries of the logger between tmin and
+    tmax, read straight into float arrays.
+    """
+    stmt = '''SELECT dt, temp, hygro FROM %s
+        WHERE logger = ? AND dt >= ? AND dt < ? ORDER BY dt'''
+    values = [numpy.fromiter(chain.from_iterable(
+        conn.execute(stmt % sensors, (logger, tmin, tmax))), dtype=float)
+        for sensors in sensorsdb.sensors_tables(conn, tmin, tmax)]
+    values = numpy.concatenate(values or [numpy.zeros(0)]).reshape(-1, 3)
+    return values[:, 0], values[:, 1], values[:, 2]
+
+
+def numpy_stats(conn, logger, edges, percentiles, thresholds):
+    """
+    Statistics of the logger in each bucket computed from its samples in
+    one vectorized pass: count, min, max, mean and percentiles of the
+    temperature and of the hygrometry, and the time (seconds) spent above
+    or below each (column, 'above' or 'below', value) threshold, each
+    sample lasting the median interval of the logger.
+    Return a list of tuples starting with the start of the bucket.
+    """
+    dates, temp, hygro = load_samples(conn, logger, edges[0], edges[-1])
+    interval = numpy.median(numpy.diff(dates)) if len(dates) > 1 else 0
+    bounds = numpy.searchsorted(dates, edges)
+    columns = {'temp': temp, 'hygro': hygro}
+
+    result = []
+    for start, first, last in zip(edges, bounds[:-1], bounds[1:]):
+        if first == last:
+            continue
+        row = [start, int(last - first)]
+        for name in ('temp', 'hygro'):
+            values = columns[name][first:last]
+            row.extend([values.min(), values.max(),
+                        round(values.mean(), 3)])
+            row.extend(round(value, 3) for value in
+                       numpy.percentile(values, percentiles))
+        for name, direction, threshold in thresholds:
+            values = columns[name][first:last]
+            if direction == 'above':
+                count = numpy.count_nonzero(values > threshold)
+            else:
+                count = numpy.count_nonzero(values < threshold)
+            row.append(int(count * interval))
+        result.append(tuple(row))
+    return result
+
+
+def stats_fields(percentiles, thresholds):
+    """ Columns of the statistics. """
+    fields = ['logger', 'start', 'date', 'count']
+    for name in ('temp', 'hygro'):
+        fields.extend([name + '_min', name + '_max', name + '_mean'])
+        fields.extend('%s_p%g' % (name, percentile)
+                      for percentile in percentiles)
+    fields.extend('%s_%s_%g_seconds' % threshold for threshold in thresholds)
+    return fields
+
+
+def iter_stats(conn, loggers, edges, percentiles, thresholds):
+    """
+    Generator of the chunks of rows of the statistics, one chunk per
+    logger. SQLite computes them unless percentiles or thresholds are
+    asked for.
+    """
+    create_buckets(conn, edges)
+    for logger in loggers:
+        if percentiles or thresholds:
+            rows = numpy_stats(conn, logger, edges, percentiles, thresholds)
+        else:
+            rows = sql_stats(conn, logger, edges)
+        yield [(logger, row[0], format_date(row[0])) + tuple(row[1:])
+               for row in rows]
+
+
+def iter_excursions(conn, loggers, tmin, tmax, alarms, stored=False):
+    """
+    Generator of the chunks of rows of the excursions (see dlalarms) of
+    the loggers between tmin and tmax, one chunk per logger: out of their
+    stored alarms overridden by the alarms dictionary, found by a
+    vectorized pass over the samples, or the stored ones. The excursions
+    found are only stored when the alarms are the stored ones.
+    """
+    for logger in loggers:
+        if stored:
+            excursions = sensorsdb.get_excursions(conn, logger, tmin, tmax)
+        else:
+            stored_alarms = sensorsdb.get_alarms(conn, logger) or {}
+            logger_alarms = dict(stored_alarms, **alarms)
+            excursions = dlalarms.scan_range(
+                conn, logger, tmin, tmax, logger_alarms,
+                logger_alarms == stored_alarms)
+        yield [dlalarms.excursion_row(logger, excursion)
+               for excursion in excursions]
+
+
+def iter_export(conn, loggers, tmin, tmax, chunk_size=10000):
+    """
+    Generator of the chunks of chunk_size rows (logger, dt, date, temp,
+    hygro) recorded between tmin and tmax, fetched from the cursors.
+    """
+    stmt = '''SELECT logger, dt, temp, hygro FROM %s
+        WHERE logger = ? AND dt >= ? AND dt < ? ORDER BY dt'''
+    for logger in loggers:
+        for sensors in sensorsdb.sensors_tables(conn, tmin, tmax):
+            cursor = conn.execute(stmt % sensors, (logger, tmin, tmax))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [(logger, dt, format_date(dt), temp, hygro)
+                       for logger, dt, temp, hygro in rows]
+
+
+def format_date(dt):
+    """ Local date of an epoch. """
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(dt))
+
+
+def write_csv(out, fields, chunks):
+    """ Write the chunks of rows as CSV, chunk by chunk. """
+    writer = csv.writer(out)
+    writer.writerow(fields)
+    for rows in chunks:
+        writer.writerows(rows)
+
+
+def write_json(out, fields, chunks):
+    """ Write the chunks of rows as a JSON list of objects, chunk by chunk. """
+    separator = "[\n"
+    for rows in chunks:
+        for row in rows:
+            out.write(separator)
+            out.write(json.dumps(dict(zip(fields, row)), sort_keys=True))
+            separator = ",\n"
+    out.write("[]\n" if separator == "[\n" else "\n]\n")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Statistics and export of the data of the sensors '
+        'database.',
+        prog='dbquery.py')
+    parser.add_argument(
+        '-c', '--command',
+        help='stats: statistics per logger and bucket, export: rows, '
+        'excursions: periods out of the alarms of the loggers.',
+        choices=('stats', 'export', 'excursions'), required=True)
+    parser.add_argument(
+        '-d', '--database',
+        help='Name of the database file (default sensors.db).',
+        default='sensors.db')
+    parser.add_argument(
+        '-m', '--month',
+        help='Month of the data (YYYYMM).')
+    parser.add_argument(
+        '-y', '--year',
+        help='Year of the data (YYYY).')
+    parser.add_argument(
+        '--from', dest='start',
+        help='Start of the data (YYYY-mm-dd [HH:MM:SS]).')
+    parser.add_argument(
+        '--to', dest='end',
+        help='End of the data, excluded (YYYY-mm-dd [HH:MM:SS]).')
+    parser.add_argument(
+        '-l', '--logger',
+        help='Logger (default: all), can be repeated.',
+        action='append')
+    parser.add_argument(
+        '-g', '--granularity',
+        help='Buckets of the statistics (default: all the range).',
+        choices=GRANULARITIES, default='all')
+    parser.add_argument(
+        '-P', '--percentiles',
+        help='Comma separated percentiles of the statistics (e.g. 5,50,95).')
+    parser.add_argument(
+        '--temp-above', type=float, action='append', default=[],
+        help='Time spent above this temperature, can be repeated '
+        '(excursions: high temperature alarm instead of the stored one, '
+        'the excursions found are then not stored).')
+    parser.add_argument(
+        '--temp-below', type=float, action='append', default=[],
+        help='Time spent below this temperature, can be repeated '
+        '(excursions: low temperature alarm).')
+    parser.add_argument(
+        '--hygro-above', type=float, action='append', default=[],
+        help='Time spent above this hygrometry, can be repeated '
+        '(excursions: high hygrometry alarm).')
+    parser.add_argument(
+        '--hygro-below', type=float, action='append', default=[],
+        help='Time spent below this hygrometry, can be repeated '
+        '(excursions: low hygrometry alarm).')
+    parser.add_argument(
+        '--stored', action='store_true',
+        help='Excursions: report the excursions stored by the previous '
+        'scans instead of scanning the samples.')
+    parser.add_argument(
+        '-F', '--format',
+        help='Output format (default csv).',
+        choices=('csv', 'json'), default='csv')
+    parser.add_argument(
+        '-o', '--output',
+        help='Output file (default: standard output).')
+    parser.add_argument(
+        '--chunk-size', type=int, default=10000,
+        help='Number of rows fetched at a time by the export '
+        '(default 10000).')
+
+    args = parser.parse_args()
+
+    commandOk = True
+    try:
+        if args.month is not None:
+            tmin, tmax = period_range(args.month)
+        elif args.year is not None:
+            tmin, tmax = period_range(args.year)
+        elif args.start is not None and args.end is not None:
+            tmin, tmax = parse_date(args.start), parse_date(args.end)
+        else:
+            print("A month, a year or a range (--from and --to) is "
+                  "mandatory.")
+            commandOk = False
+        percentiles = [float(percentile) for percentile in
+                       args.percentiles.split(',')] \
+            if args.percentiles else []
+    except ValueError as err:
+        print(err)
+        commandOk = False
+
+    if not commandOk:
+        print("Command line error...")
+        sys.exit(2)
+
+    thresholds = [(name, direction, value)
+                  for name in ('temp', 'hygro')
+                  for direction in ('above', 'below')
+                  for value in getattr(args, name + '_' + direction)]
+
+    conn = sensorsdb.connect(args.database)
+    loggers = args.logger or sensorsdb.get_loggers(conn)
+
+    if args.command == 'stats':
+        fields = stats_fields(percentiles, thresholds)
+        chunks = iter_stats(conn, loggers,
+                            bucket_edges(args.granularity, tmin, tmax),
+                            percentiles, thresholds)
+    elif args.command == 'excursions':
+        fields = dlalarms.EXCURSION_FIELDS
+        alarms = dict(('%s_%s' % (name, 'high' if direction == 'above'
+                                  else 'low'), value)
+                      for name, direction, value in thresholds)
+        chunks = iter_excursions(conn, loggers, tmin, tmax, alarms,
+                                 args.stored)
+    else:
+        fields = EXPORT_FIELDS
+        chunks = iter_export(conn, loggers, tmin, tmax, args.chunk_size)
+
+    out = sys.stdout if args.output is None else open(args.output, 'w')
+    try:
+        if args.format == 'json':
+            write_json(out, fields, chunks)
+        else:
+            write_csv(out, fields, chunks)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        conn.close()
+
+    sys.exit(0)
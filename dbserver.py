@@ -0,0 +1,364 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# dbserver - Local HTTP server of the Voltcraft DL-120TH data stored in the
+# sensors database.
+#
+# Copyright 2015 Patrick Rabu
+
+import argparse
+import io
+import json
+import locale
+import os
+import sys
+
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs, urlparse
+
+import numpy
+
+import dbquery
+import plotdb
+import sensorsdb
+
+# End of the range of the responses that change with every new data
+FOREVER = 2 ** 62
+
+SERIES_FIELDS = ('temp', 'hygro', 'temp_min', 'temp_max', 'hygro_min',
+                 'hygro_max')
+
+
+class ResponseCache:
+    """
+    LRU cache of at most size responses. Each response is stored with the
+    loggers it depends on (None for all of them) and the end of its range,
+    so that it is only dropped when a logger it shows gets data before
+    that end.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """ Response of key, None if not cached. """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, response, loggers, end):
+        """ Cache a response, evicting the least recently used ones. """
+        self.entries.pop(key, None)
+        self.entries[key] = (response, loggers, end)
+        while len(self.entries) > self.size:
+            self.entries.popitem(False)
+
+    def invalidate(self, advanced):
+        """
+        Drop the responses made stale by new data, advanced being a
+        dictionary of the previous watermark (None if none) of each logger
+        whose watermark moved: its new data are after it.
+        """
+        for key, (response, loggers, end) in list(self.entries.items()):
+            for logger, previous in advanced.items():
+                if (loggers is None or logger in loggers) and \
+                        (previous is None or end > previous + 1):
+                    del self.entries[key]
+                    break
+
+
+def db_stamp(database):
+    """ Modification time and size of the database and of its WAL file. """
+    stamp = []
+    for fn in (database, database + '-wal'):
+        try:
+            st = os.stat(fn)
+        except OSError:
+            continue
+        stamp.append((st.st_mtime, st.st_size))
+    return tuple(stamp)
+
+
+def param(params, name, default=None):
+    """ Last value of a query string parameter. """
+    values = params.get(name)
+    if not values:
+        return default
+    return values[-1]
+
+
+def request_range(server, params, loggers):
+    """
+    Range [tmin, tmax[ and title of the month (YYYYMM), year (YYYY),
+    from / to dates or last hours (before the latest data of the loggers)
+    of the query string, and the end of the data it depends on (the last
+    hours move with every new data).
+    """
+    end = None
+    month = param(params, 'month')
+    year = param(params, 'year')
+    hours = param(params, 'hours')
+    if month is not None:
+        if len(month) != 6 or not month.isdigit():
+            raise ValueError("Invalid month: %s" % month)
+        tmin, tmax = dbquery.period_range(month)
+        title = datetime.fromtimestamp(tmin).strftime("Releves de %B %Y")
+    elif year is not None:
+        if len(year) != 4 or not year.isdigit():
+            raise ValueError("Invalid year: %s" % year)
+        tmin, tmax = dbquery.period_range(year)
+        title = datetime.fromtimestamp(tmin).strftime("Releves de %Y")
+    elif param(params, 'from') is not None and \
+            param(params, 'to') is not None:
+        tmin = dbquery.parse_date(param(params, 'from'))
+        tmax = dbquery.parse_date(param(params, 'to'))
+        title = "Releves du %s au %s" % (param(params, 'from'),
+                                         param(params, 'to'))
+    elif hours is not None:
+        watermarks = [dt for logger, dt in server.watermarks.items()
+                      if loggers is None or logger in loggers]
+        tmax = max(watermarks or [0]) + 1
+        tmin = tmax - int(float(hours) * 3600)
+        title = "Releves des %s dernieres heures" % hours
+        end = FOREVER
+    else:
+        raise ValueError("month, year, from and to or hours is mandatory")
+    if tmin >= tmax:
+        raise ValueError("Empty range")
+    return tmin, tmax, end or tmax, title
+
+
+def request_series(server, params):
+    """
+    Series of the loggers of the query string (all if none) over its
+    range, reduced to points buckets (default: those of the server).
+    Return the loggers (None for all), tmin, tmax, end (see request_range),
+    title and the series.
+    """
+    loggers = params.get('logger')
+    tmin, tmax, end, title = request_range(server, params, loggers)
+    points = int(param(params, 'points', server.points))
+    series = plotdb.load_db(server.database, datetime.fromtimestamp(tmin),
+                            datetime.fromtimestamp(tmax), points, loggers)
+    return loggers, tmin, tmax, end, title, series
+
+
+def latest(server, params):
+    """ Latest reading of each logger (or of the logger parameters). """
+    loggers = params.get('logger')
+    readings = []
+    for logger in sorted(server.watermarks):
+        if loggers is not None and logger not in loggers:
+            continue
+        dt = server.watermarks[logger]
+        for sensors in sensorsdb.sensors_tables(server.conn, dt, dt + 1):
+            for temp, hygro in server.conn.execute(
+                    'SELECT temp, hygro FROM %s WHERE logger = ? AND dt = ?'
+                    % sensors, (logger, dt)):
+                readings.append({'logger': logger, 'dt': dt,
+                                 'date': dbquery.format_date(dt),
+                                 'temp': temp, 'hygro': hygro})
+    body = json.dumps(readings, sort_keys=True)
+    return ('application/json', body.encode('utf-8')), loggers, FOREVER
+
+
+def series_range(server, params):
+    """ Series of a range as JSON (default) or CSV. """
+    loggers, tmin, tmax, end, title, series = request_series(server,
+                                                             params)
+    fields = [field for field in SERIES_FIELDS
+              if any(getattr(s, field) is not None for s in series)]
+
+    if param(params, 'format', 'json') == 'csv':
+        lines = [",".join(('logger', 'dt') + tuple(fields))]
+        for s in series:
+            columns = [numpy.round(getattr(s, field), 3).tolist()
+                       for field in fields]
+            for dt, values in zip(s.dates.astype(int).tolist(),
+                                  zip(*columns)):
+                lines.append(",".join([s.logger, str(dt)] +
+                                      [str(value) for value in values]))
+        body = "\n".join(lines) + "\n"
+        content_type = 'text/csv'
+    else:
+        result = []
+        for s in series:
+            entry = {'logger': s.logger,
+                     'dt': s.dates.astype(int).tolist()}
+            for field in fields:
+                entry[field] = numpy.round(getattr(s, field), 3).tolist()
+            result.append(entry)
+        body = json.dumps(result, sort_keys=True)
+        content_type = 'application/json'
+    return (content_type, body.encode('utf-8')), loggers, end
+
+
+def series_plot(server, params):
+    """ PNG plot of the series of a range, as plotted by plotdb. """
+    loggers, tmin, tmax, end, title, series = request_series(server,
+                                                             params)
+    png = io.BytesIO()
+    plotdb.plot(series, datetime.fromtimestamp(tmin),
+                datetime.fromtimestamp(tmax), title, png)
+    return ('image/png', png.getvalue()), loggers, end
+
+
+ROUTES = {
+    '/latest': latest,
+    '/range': series_range,
+    '/plot': series_plot,
+}
+
+
+class SensorsServer(HTTPServer):
+    """
+    HTTP server of a sensors database, keeping its connection, the
+    watermarks of the loggers and the cache of the responses between the
+    requests (served one at a time).
+    """
+    def __init__(self, address, database, cache_size=64, points=None,
+                 quiet=False):
+        HTTPServer.__init__(self, address, SensorsHandler)
+        self.database = database
+        self.conn = sensorsdb.connect(database)
+        self.cache = ResponseCache(cache_size)
+        self.points = plotdb.FIGSIZE[0] * plotdb.DPI \
+            if points is None else points
+        self.quiet = quiet
+        self.stamp = None
+        self.watermarks = {}
+
+    def refresh(self):
+        """
+        Drop the cached responses made stale by an ingest. The watermarks
+        are only read again when the database files changed.
+        """
+        stamp = db_stamp(self.database)
+        if stamp == self.stamp:
+            return
+        self.stamp = stamp
+
+        watermarks = dict(self.conn.execute(
+            'SELECT logger, dt FROM watermarks'))
+        advanced = dict((logger, self.watermarks.get(logger))
+                        for logger, dt in watermarks.items()
+                        if dt != self.watermarks.get(logger))
+        self.watermarks = watermarks
+        if advanced:
+            self.cache.invalidate(advanced)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.conn.close()
+
+
+class SensorsHandler(BaseHTTPRequestHandler):
+    """
+    GET /latest, /range and /plot, the range being given by month=YYYYMM,
+    year=YYYY, from=DATE&to=DATE or hours=N, the loggers by logger=NAME
+    (repeated, default: all).
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        route = ROUTES.get(url.path)
+        if route is None:
+            self.send_error(404)
+            return
+
+        server = self.server
+        server.refresh()
+        params = parse_qs(url.query)
+        key = (url.path, tuple(sorted((name, tuple(values))
+                                      for name, values in params.items())))
+        response = server.cache.get(key)
+        cache_status = 'hit'
+        if response is None:
+            try:
+                response, loggers, end = route(server, params)
+            except ValueError as err:
+                self.send_error(400, str(err))
+                return
+            server.cache.put(key, response, loggers, end)
+            cache_status = 'miss'
+
+        content_type, body = response
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Cache', cache_status)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Local HTTP server of the data of the sensors '
+        'database.',
+        prog='dbserver.py')
+    parser.add_argument(
+        '-d', '--database',
+        help='Name of the database file (default sensors.db).',
+        default='sensors.db')
+    parser.add_argument(
+        '-a', '--address',
+        help='Address to listen on (default 127.0.0.1).',
+        default='127.0.0.1')
+    parser.add_argument(
+        '-P', '--port', type=int, default=8120,
+        help='Port to listen on (default 8120).')
+    parser.add_argument(
+        '-c', '--cache-size', type=int, default=64,
+        help='Number of responses kept in the cache (default 64).')
+    parser.add_argument(
+        '-p', '--points', type=int,
+        help='Default number of buckets of the ranges and plots, 0 for '
+        'every data (default: width of the figure in pixels).')
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help='Do not log the requests.')
+
+    args = parser.parse_args()
+
+    commandOk = True
+
+    if not os.path.exists(args.database):
+        print("Database not found:", args.database)
+        commandOk = False
+
+    if args.cache_size < 1:
+        print("Cache size should be greater than 0.")
+        commandOk = False
+
+    if not commandOk:
+        print("Command line error...")
+        sys.exit(2)
+
+    locale.setlocale(locale.LC_TIME, '')
+
+    server = SensorsServer((args.address, args.port), args.database,
+                           args.cache_size, args.points, args.quiet)
+    print("Serving", args.database,
+          "on http://%s:%i/" % (args.address, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    sys.exit(0)
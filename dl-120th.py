@@ -7,11 +7,88 @@
 
 import argparse
 import sys
+import time
 import usb
-import sqlite3
 
+from array import array
+from multiprocessing.pool import ThreadPool
+from threading import Event, Thread
 from datetime import datetime, timedelta
 from struct import pack, unpack
+from timeit import default_timer as timer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from queue import Full, Queue
+except ImportError:
+    from Queue import Full, Queue
+
+import dlalarms
+import dlformats
+import dlmetrics
+import sensorsdb
+
+
+def decode_samples(buf, count):
+    """
+    Decode count samples from the raw data packets gathered in buf.
+    Each sample is a little endian int16 temperature followed by an int16
+    relative humidity, both in tenth of unit.
+    Return the temperatures and the relative humidities as typed arrays
+    (numpy int16 arrays when numpy is available, array('h') otherwise).
+    """
+    if numpy is not None:
+        pairs = numpy.frombuffer(buf, dtype='<i2', count=2 * count)
+        return pairs[0::2], pairs[1::2]
+
+    pairs = array('h')
+    raw = bytes(buf[:4 * count])
+    if hasattr(pairs, 'frombytes'):
+        pairs.frombytes(raw)
+    else:
+        pairs.fromstring(raw)
+    if sys.byteorder == 'big':
+        pairs.byteswap()
+    return pairs[0::2], pairs[1::2]
+
+
+def for_each(function, loggers):
+    """
+    Call function on each logger, in a thread per logger when there are
+    several of them. Return the list of the results.
+    """
+    if len(loggers) == 1:
+        return [function(loggers[0])]
+
+    pool = ThreadPool(len(loggers))
+    try:
+        return pool.map(function, loggers)
+    finally:
+        pool.close()
+
+
+def open_logger(dl120th):
+    """ Acquire the logger and read its configuration. """
+    dl120th.open()
+    dl120th.read_config()
+
+
+def open_loggers(loggers):
+    """
+    Open the loggers concurrently (see open_logger). If one of them fails,
+    the ones opened are released before the error is raised again.
+    """
+    try:
+        for_each(open_logger, loggers)
+    except Exception:
+        for dl120th in loggers:
+            if dl120th.handle is not None:
+                dl120th.close()
+        raise
 
 
 class DeviceDescriptor:
@@ -20,13 +97,26 @@ class DeviceDescriptor:
         self.product_id = product_id
         self.interface_id = interface_id
 
-    def get_device(self):
+    def get_devices(self):
+        """
+        All the matching devices plugged in, as a list of
+        (address, device) where address is "bus:device".
+        """
+        devices = []
         buses = usb.busses()
         for bus in buses:
             for device in bus.devices:
                 if device.idVendor == self.vendor_id:
                     if device.idProduct == self.product_id:
-                        return device
+                        address = bus.dirname + ":" + device.filename
+                        devices.append((address, device))
+        return devices
+
+    def get_device(self, address=None):
+        """ First matching device, at address if given. """
+        for device_address, device in self.get_devices():
+            if address is None or address == device_address:
+                return device
         return None
 
 
@@ -42,48 +132,58 @@ class Dl120th:
     BULK_OUT_EP = 0x02      # Endpoint for Bulk writes
     PACKET_LENGTH = 0x40    # 64 bytes
 
-    THRESHOLD = [
-        0x0000, 0x3F80, 0x4000, 0x4040, 0x4080, 0x40A0, 0x40C0, 0x40E0,
-        0x4100, 0x4110, 0x4120, 0x4130, 0x4140, 0x4150, 0x4160, 0x4170,
-        0x4180, 0x4188, 0x4190, 0x4198, 0x41A0, 0x41A8, 0x41B0, 0x41B8,
-        0x41C0, 0x41C8, 0x41D0, 0x41D8, 0x41E0, 0x41E8, 0x41F0, 0x41F8,
-        0x4200, 0x4204, 0x4208, 0x420C, 0x4210, 0x4214, 0x4218, 0x421C,
-        0x4220, 0x4224, 0x4228, 0x422C, 0x4230, 0x4234, 0x4238, 0x423C,
-        0x4240, 0x4244, 0x4248, 0x424C, 0x4250, 0x4254, 0x4258, 0x425C,
-        0x4260, 0x4264, 0x4268, 0x426C, 0x4270, 0x4274, 0x4278, 0x427C,
-        0x4280, 0x4282, 0x4284, 0x4286, 0x4288, 0x428A, 0x428C, 0x428E,
-        0x4290, 0x4292, 0x4294, 0x4296, 0x4298, 0x429A, 0x429C, 0x429E,
-        0x42A0, 0x42A2, 0x42A4, 0x42A6, 0x42A8, 0x42AA, 0x42AC, 0x42AE,
-        0x42B0, 0x42B2, 0x42B4, 0x42B6, 0x42B8, 0x42BA, 0x42BC, 0x42BE,
-        0x42C0, 0x42C2, 0x42C4, 0x42C6, 0x42C8]
-
-    num_data = 0
-    temp = []
-    rh = []
+    # Codes of the thresholds of the alarms
+    THRESHOLD = dlalarms.THRESHOLD
 
     device_descriptor = DeviceDescriptor(VENDOR_ID, PRODUCT_ID, INTERFACE_ID)
 
-    def __init__(self,):
-        # The actual device (PyUSB object)
-        self.device = self.device_descriptor.get_device()
+    def __init__(self, device=None, timeout=1000, retries=3, backoff=0.5,
+                 address=None, verbose=False):
+        # Timings and counters of the session (dlmetrics.Metrics)
+        self.metrics = dlmetrics.Metrics()
+        # The actual device (PyUSB object or a stand-in with the same
+        # interface such as dl120emu.Dl120thEmulator)
+        if device is None:
+            with self.metrics.phase('discovery'):
+                device = self.device_descriptor.get_device()
+        self.device = device
+        # Address (bus:device) of the device, used in the reports
+        self.address = address
+        # Print the raw answers of the device
+        self.verbose = verbose
         # Handle that is used to communicate with device. Setup in L{open}
         self.handle = None
         self.status = (0, 0, 0, 0)
-
+        # Timeout of each USB transfer in milliseconds
+        self.timeout = timeout
+        # Number of times a failed download is resumed in a row, and delay
+        # before the first retry in seconds (doubled at each retry)
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_count = 0
+        # Number of data received by the running download
+        self.num_data = 0
+        # Data downloaded by read_data (dlformats.SampleSeries in tenth of
+        # unit), None if not read
+        self.temp = None
+        self.rh = None
+
+    @dlmetrics.timed('open')
     def open(self):
-        """ Acquire device interface """
-        self.device = self.device_descriptor.get_device()
+        """
+        Acquire device interface, raise IOError if the device isn't plugged
+        in and usb.USBError if it can't be opened.
+        """
+        if self.device is None:
+            with self.metrics.phase('discovery'):
+                self.device = self.device_descriptor.get_device()
         if not self.device:
-            print("Device isn't plugged in.")
-            sys.exit(1)
+            raise IOError("Device isn't plugged in.")
 
-        try:
-            self.handle = self.device.open()
-            self.handle.claimInterface(self.device_descriptor.interface_id)
-        except usb.USBError as err:
-            print(err)
-            sys.exit(1)
+        self.handle = self.device.open()
+        self.handle.claimInterface(self.device_descriptor.interface_id)
 
+    @dlmetrics.timed('close')
     def close(self):
         """ Release device interface """
         try:
@@ -94,28 +194,38 @@ class Dl120th:
 
         self.handle, self.device = None, None
 
+    @dlmetrics.timed('read_config')
     def read_config(self):
-        """ Read the configuration. """
+        """
+        Read the configuration.
+        The data downloaded before belong to the previous recording and
+        are dropped.
+        """
+        self.temp, self.rh = None, None
 
         msg = [0x00, 0x10, 0x01]
 
         # Write the request
-        sent_bytes = self.handle.bulkWrite(Dl120th.BULK_OUT_EP, msg, 1000)
-        print("Read Config request return:", sent_bytes)
+        sent_bytes = self.handle.bulkWrite(Dl120th.BULK_OUT_EP, msg,
+                                           self.timeout)
+        if self.verbose:
+            print("Read Config request return:", sent_bytes)
 
         # Read the response (Status)
         if (sent_bytes):
             read_bytes = self.handle.bulkRead(Dl120th.BULK_IN_EP,
                                               Dl120th.PACKET_LENGTH,
-                                              1000)
+                                              self.timeout)
 
-        print("Read Config response return:", read_bytes)
+        if self.verbose:
+            print("Read Config response return:", read_bytes)
 
         # Read the configuration
         data = self.handle.bulkRead(Dl120th.BULK_IN_EP,
                                     Dl120th.PACKET_LENGTH,
-                                    1000)
-        print("Config data:", data)
+                                    self.timeout)
+        if self.verbose:
+            print("Config data:", data)
 
         # Unpack the configuration data
         self.logger_state, \
@@ -150,7 +260,7 @@ class Dl120th:
         self.logger_name = self.logger_name.replace('\00', '')
 
     def write_config(self, name, num_data, interval, start):
-        """ Write the configuration. """
+        """ Write the configuration, raise IOError if it is refused. """
         print("DL120TH Logger=", self.logger_name, " numdata=",
               self.num_data_conf, "@", self.interval, " sec. ",
               "Start=", self.logger_start)
@@ -188,23 +298,25 @@ class Dl120th:
         msg = [0x01, 0x40, 0x00]
 
         # Ask for configuration write
-        ret = self.handle.bulkWrite(Dl120th.BULK_OUT_EP, msg, 1000)
-        print("Config return:", ret)
+        ret = self.handle.bulkWrite(Dl120th.BULK_OUT_EP, msg, self.timeout)
+        if self.verbose:
+            print("Config return:", ret)
 
         if (ret):
             # Send the configuration
-            ret = self.handle.bulkWrite(Dl120th.BULK_OUT_EP, buf, 1000)
+            ret = self.handle.bulkWrite(Dl120th.BULK_OUT_EP, buf,
+                                        self.timeout)
 
         if (ret):
             # Read the response
             data = self.handle.bulkRead(Dl120th.BULK_IN_EP,
-                                        Dl120th.PACKET_LENGTH, 1000)
+                                        Dl120th.PACKET_LENGTH, self.timeout)
 
             if (data):
                 # print "Return code:", data[0] & 0xff
                 if (data[0] & 0xff) != 0xff:
-                    print "Error writing configuration", hex(data[0])
-                    sys.exit(1)
+                    raise IOError("Error writing configuration %s"
+                                  % hex(data[0]))
 
     def print_config(self):
         """ Print the configuration. """
@@ -229,146 +341,305 @@ class Dl120th:
                   "the red button to start logging)")
         else:
             print("\t>Start logging: Automatic")
-        print("\t>Threshold temp low:",
-              Dl120th.THRESHOLD.index(self.thresh_temp_low))
-        print("\t>Threshold temp high:",
-              Dl120th.THRESHOLD.index(self.thresh_temp_high))
-        print("\t>Threshold rh low:",
-              Dl120th.THRESHOLD.index(self.thresh_rh_low))
-        print("\t>Threshold rh high:",
-              Dl120th.THRESHOLD.index(self.thresh_rh_high))
+        alarms = self.alarms()
+        print("\t>Threshold temp low:", alarms['temp_low'])
+        print("\t>Threshold temp high:", alarms['temp_high'])
+        print("\t>Threshold rh low:", alarms['hygro_low'])
+        print("\t>Threshold rh high:", alarms['hygro_high'])
         print("\t>logger end:", hex(self.logger_end))
         print("Configuration end\n")
 
-    def read_data(self):
-        """ Read data recorded. """
+    def alarms(self):
+        """ Thresholds of the alarms (dictionary of sensorsdb.ALARMS). """
+        return {'temp_low': dlalarms.decode_threshold(self.thresh_temp_low),
+                'temp_high': dlalarms.decode_threshold(self.thresh_temp_high),
+                'hygro_low': dlalarms.decode_threshold(self.thresh_rh_low),
+                'hygro_high': dlalarms.decode_threshold(self.thresh_rh_high)}
+
+    def read_packets(self):
+        """
+        Generator of the raw data packets recorded (16 samples per packet),
+        the keep alive messages being sent along the way.
+        When a transfer fails, the download is requested again after a
+        backoff delay (up to retries times in a row) and resumes after the
+        last packet fully received: the logger always sends its data from
+        the start, so the packets already received are read again and
+        discarded.
+        """
+        self.num_data = 0
+        self.retry_count = 0
+
         # No data to read
         if (self.num_data_rec == 0):
             return
 
+        attempt = 0
+        while True:
+            try:
+                for packet in self.transfer_packets(self.num_data):
+                    attempt = 0
+                    yield packet
+                break
+            except (usb.USBError, IOError) as err:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                self.retry_count += 1
+                self.metrics.count('retries')
+                print("Transfer error:", err, " retry", attempt, "in",
+                      delay, "s from data", self.num_data)
+                time.sleep(delay)
+
+    def transfer_packets(self, resume=0):
+        """
+        Request the data and yield the packets following the resume first
+        samples (a multiple of 16), self.num_data being the number of
+        samples yielded.
+        The time spent in the transfers is added to the read_data phase and
+        to the stretch between two keep alive messages.
+        """
+        started = timer()
+        stretch = 0.0
+
         # Ask for the data
         msg = [0x00, 0x00, 0x40]
-        sent_bytes = self.handle.bulkWrite(Dl120th.BULK_OUT_EP, msg, 1000)
+        sent_bytes = self.handle.bulkWrite(Dl120th.BULK_OUT_EP, msg,
+                                           self.timeout)
 
         # Read the response (Status)
         if (sent_bytes):
-            data = self.handle.bulkRead(Dl120th.BULK_IN_EP,
-                                        Dl120th.PACKET_LENGTH, 1000)
-            print("Status:", data, " - ", len(data))
-
-        # Read the data
-        data = self.handle.bulkRead(Dl120th.BULK_IN_EP,
-                                    Dl120th.PACKET_LENGTH, 1000)
-
-        # Unpack the data
-        temp00, rh00, temp01, rh01, temp02, rh02, temp03, rh03,\
-            temp04, rh04, temp05, rh05, temp06, rh06, temp07, rh07, \
-            temp08, rh08, temp09, rh09, temp10, rh10, temp11, rh11, \
-            temp12, rh12, temp13, rh13, temp14, rh14, temp15, rh15 = \
-            unpack("hhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhh",
-                   ''.join([chr(x) for x in data]))
-        self.rh.extend([rh00, rh01, rh02, rh03, rh04, rh05, rh06, rh07])
-        self.rh.extend([rh08, rh09, rh10, rh11, rh12, rh13, rh14, rh15])
-        self.temp.extend([temp00, temp01, temp02, temp03,
-                          temp04, temp05, temp06, temp07])
-        self.temp.extend([temp08, temp09, temp10, temp11,
-                          temp12, temp13, temp14, temp15])
-        self.num_data += 16
-
-        while self.num_data < self.num_data_rec:
-            if (self.num_data_rec - self.num_data < 16):
-                print("data to read : ", self.num_data_rec - self.num_data)
-
-            # Read the data
-            data = self.handle.bulkRead(Dl120th.BULK_IN_EP,
-                                        Dl120th.PACKET_LENGTH, 1000)
-            # print "Data:", hex(data), " - ", len(data)
-
-            # Unpack the data
-            temp00, rh00, temp01, rh01, temp02, rh02, temp03, rh03, \
-                temp04, rh04, temp05, rh05, temp06, rh06, temp07, rh07, \
-                temp08, rh08, temp09, rh09, temp10, rh10, temp11, rh11, \
-                temp12, rh12, temp13, rh13, temp14, rh14, temp15, rh15 = \
-                unpack("hhhhhhhhhhhhhhhhhhhhhhhhhhhhhhhh",
-                       ''.join([chr(x) for x in data]))
-            self.rh.extend([rh00, rh01, rh02, rh03,
-                            rh04, rh05, rh06, rh07])
-            self.rh.extend([rh08, rh09, rh10, rh11,
-                            rh12, rh13, rh14, rh15])
-            self.temp.extend([temp00, temp01, temp02, temp03,
-                              temp04, temp05, temp06, temp07])
-            self.temp.extend([temp08, temp09, temp10, temp11,
-                              temp12, temp13, temp14, temp15])
-            self.num_data += 16
+            self.status = tuple(self.handle.bulkRead(Dl120th.BULK_IN_EP,
+                                                     Dl120th.PACKET_LENGTH,
+                                                     self.timeout))
+
+        received = 0
+        while received < self.num_data_rec:
+            # Read the data (16 samples per packet)
+            packet = self.handle.bulkRead(Dl120th.BULK_IN_EP,
+                                          Dl120th.PACKET_LENGTH,
+                                          self.timeout)
+            if len(packet) != Dl120th.PACKET_LENGTH:
+                raise IOError("Short packet: %i bytes" % len(packet))
+            received += 16
+            self.metrics.count('packets')
+            self.metrics.count('bytes', len(packet))
 
             # Every 1024 data, send a keep alive message
-            if self.num_data % 1024 == 0:
+            if received % 1024 == 0:
                 # Keep alive message
                 msg = [0x00, 0x01, 0x40]
                 sent_bytes = self.handle.bulkWrite(Dl120th.BULK_OUT_EP,
-                                                   msg, 1000)
+                                                   msg, self.timeout)
 
                 # Read the response (Status)
                 if (sent_bytes):
                     data = self.handle.bulkRead(Dl120th.BULK_IN_EP,
                                                 Dl120th.PACKET_LENGTH,
-                                                1000)
+                                                self.timeout)
+
+            now = timer()
+            self.metrics.add('read_data', now - started)
+            stretch += now - started
+            if received % 1024 == 0:
+                self.metrics.stretches.append(stretch)
+                stretch = 0.0
+
+            if received > resume:
+                self.num_data = received
+                yield packet
+            started = timer()
+
+        if stretch:
+            self.metrics.stretches.append(stretch)
+
+    def read_data(self):
+        """
+        Read data recorded and keep them: the next iterations over the
+        data (iter_chunks, iter_samples, print and save) use them instead
+        of downloading again.
+        """
+        # Gather the raw packets, they are decoded all at once at the end
+        packets = bytearray()
+        for packet in self.read_packets():
+            packets.extend(packet)
+
+        # Unpack the data
+        with self.metrics.phase('decode'):
+            temp, rh = decode_samples(packets, self.num_data_rec)
+        start = int(self.start_rec.strftime("%s"))
+        self.temp = dlformats.SampleSeries(temp, start, self.interval)
+        self.rh = dlformats.SampleSeries(rh, start, self.interval)
+
+    def iter_chunks(self, queue_size=256, chunk_packets=64):
+        """
+        Generator of the data recorded by chunks of chunk_packets packets
+        (16 samples per packet), as (index of the first sample, temp, rh),
+        temp and rh being in tenth of unit.
+        The data are downloaded unless read_data kept them: the USB reads
+        are issued by a reader thread handing the raw packets through a
+        queue of queue_size packets, so that the reads go on while the
+        chunks are decoded and consumed. When the consumer stops early
+        (error or generator closed), the reader thread is stopped and
+        joined.
+        """
+        if self.temp is not None:
+            size = 16 * chunk_packets
+            for first in range(0, self.num_data_rec, size):
+                yield (first, self.temp.raw[first:first + size],
+                       self.rh.raw[first:first + size])
+            return
+
+        packets = Queue(queue_size)
+        errors = []
+        stop = Event()
+
+        def put(packet):
+            """ Queue a packet, False if the consumer stopped. """
+            while not stop.is_set():
+                try:
+                    packets.put(packet, True, 0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def reader():
+            try:
+                for packet in self.read_packets():
+                    if not put(packet):
+                        break
+            except Exception as err:
+                errors.append(err)
+            finally:
+                put(None)
+
+        thread = Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+
+        first = 0
+        buf = bytearray()
+        done = finished = False
+        try:
+            while not done:
+                packet = packets.get()
+                if packet is not None:
+                    buf.extend(packet)
+                    if len(buf) < chunk_packets * Dl120th.PACKET_LENGTH:
+                        continue
+
+                count = min(len(buf) // 4, self.num_data_rec - first)
+                done = packet is None
+                if count > 0:
+                    with self.metrics.phase('decode'):
+                        temp, rh = decode_samples(buf, count)
+                    yield first, temp, rh
+                    first += count
+                buf = bytearray()
+            finished = True
+        finally:
+            stop.set()
+            thread.join()
+            if errors and not finished:
+                # The consumer stopped first, its own error goes on
+                print("Download stopped:", errors[0])
+
+        if errors:
+            raise errors[0]
+
+    def download(self, sinks, queue_size=256, chunk_packets=64):
+        """
+        Download the data recorded through a pipeline: the samples are
+        handed to the sinks chunk by chunk as they are received and
+        decoded (see iter_chunks), without keeping the whole recording.
+        """
+        try:
+            for first, temp, rh in self.iter_chunks(queue_size,
+                                                    chunk_packets):
+                with self.metrics.phase('save'):
+                    for sink in sinks:
+                        sink.write(first, temp, rh)
+        finally:
+            with self.metrics.phase('save'):
+                for sink in sinks:
+                    sink.close()
+
+    def iter_samples(self, queue_size=256, chunk_packets=64):
+        """
+        Generator of the (epoch, temp, rh) samples recorded, temp and rh
+        being in unit (see iter_chunks).
+        """
+        start = int(self.start_rec.strftime("%s"))
+        for first, temp, rh in self.iter_chunks(queue_size, chunk_packets):
+            temp = dlformats.SampleSeries(temp, start + first * self.interval,
+                                          self.interval)
+            rh = dlformats.SampleSeries(rh, temp.start, self.interval)
+            dt = temp.start
+            for t, h in zip(temp.values(), rh.values()):
+                yield dt, t, h
+                dt += self.interval
 
     def print_data(self):
-        """ Print the data """
-        for i in range(self.num_data_rec):
-            data_datetime = self.start_rec + \
-                timedelta(seconds=(i * self.interval))
-            print(i, str(data_datetime),
-                  data_datetime.strftime("%s"),
-                  self.temp[i] / 10.0,
-                  self.rh[i] / 10.0)
+        """ Print the data, then their excursions out of the alarms """
+        temps = []
+        rhs = []
+        for first, temp, rh in self.iter_chunks():
+            epochs, datetimes = dlformats.dat_timestamps(
+                self.start_rec + timedelta(seconds=first * self.interval),
+                self.interval, len(temp))
+            temp = temp.tolist()
+            rh = rh.tolist()
+            for i in range(len(temp)):
+                print(first + i, datetimes[i], epochs[i],
+                      temp[i] / 10.0, rh[i] / 10.0)
+            temps.extend(temp)
+            rhs.extend(rh)
+
+        start = int(self.start_rec.strftime("%s"))
+        temp = dlformats.SampleSeries(temps, start, self.interval)
+        rh = dlformats.SampleSeries(rhs, start, self.interval)
+        dlalarms.print_excursions(dlalarms.logger_excursions(
+            temp.times(), temp.values(), rh.values(), self.alarms(),
+            self.interval))
 
     def save_data_to_file(self, fn):
         """ Save data in text file. """
+        self.download([DatSink(fn, self)])
+
+    def save_data_to_bin(self, fn):
+        """ Save data in binary file (the whole data are read first). """
+        if self.temp is None:
+            self.read_data()
         print("Filename:", fn)
-        with open(fn, "w", 4096) as datafile:
-            line = "# %s [%s] %i points @ %i sec\n" % (
-                self.logger_name,
-                self.start_rec.strftime("%Y-%m-%d %H:%M:%S"),
-                self.num_data_rec,
-                self.interval)
-            datafile.write(line)
-
-            for i in range(self.num_data_rec):
-                data_datetime = self.start_rec + \
-                    timedelta(seconds=(i * self.interval))
-                line = data_datetime.strftime("%s") + " " + \
-                    data_datetime.strftime("%Y-%m-%d %H:%M:%S") + " " + \
-                    str(self.temp[i] / 10.0) + " " + \
-                    str(self.rh[i] / 10.0) + '\n'
-                datafile.write(line)
-
-        datafile.close()
+        with self.metrics.phase('save'):
+            dlformats.write_bin(fn, self.logger_name,
+                                int(self.start_rec.strftime("%s")),
+                                self.interval, self.num_data_rec,
+                                self.temp.raw, self.rh.raw,
+                                self.temp_fahrenheit)
+
+    def save_data_to_dla(self, fn):
+        """ Save data in a dla archive, block by block. """
+        self.download([DlaSink(fn, self)])
 
     def save_data_to_db(self, db):
-        """ Save data in SQLite database. """
-        print("Database:", db)
-        conn = sqlite3.connect(db)
-        c = conn.cursor()
-
-        for i in range(self.num_data_rec):
-            data_datetime = self.start_rec
-            + timedelta(seconds=(i * self.interval))
-            c.execute('INSERT INTO sensors VALUES (?, ?, ?, ?)', (
-                self.logger_name,
-                data_datetime.strftime("%s"),
-                self.temp[i] / 10.0,
-                self.rh[i] / 10.0))
+        """
+        Save data in SQLite database, in a transaction per chunk.
+        The data already stored (up to the logger watermark) are skipped.
+        """
+        self.download([DbSink(db, self)])
 
     def write(self, msg):
-        sent_bytes = self.handle.bulkWrite(Dl120th.BULK_OUT_EP, msg, 1000)
+        sent_bytes = self.handle.bulkWrite(Dl120th.BULK_OUT_EP, msg,
+                                           self.timeout)
         print("sent_bytes: ", sent_bytes)
 
     def read(self):
         try:
             data = self.handle.interruptRead(Dl120th.BULK_OUT_EP,
-                                             Dl120th.PACKET_LENGTH, 1000)
+                                             Dl120th.PACKET_LENGTH,
+                                             self.timeout)
             print("data length: ", len(data), " data: ", data)
             return data
         except usb.USBError:
@@ -377,6 +648,253 @@ class Dl120th:
                 raise usb.USBError
 
 
+class DatSink:
+    """ Write the chunks of a pipelined download in a dat file. """
+    def __init__(self, fn, dl120th):
+        print("Filename:", fn)
+        self.dl120th = dl120th
+        self.datafile = open(fn, "w", 65536)
+        self.datafile.write(dlformats.dat_header(
+            dl120th.logger_name, dl120th.start_rec, dl120th.interval,
+            dl120th.num_data_rec))
+
+    def write(self, first, temp, rh):
+        start = self.dl120th.start_rec + \
+            timedelta(seconds=first * self.dl120th.interval)
+        self.datafile.write(dlformats.dat_text(
+            start, self.dl120th.interval, len(temp), temp, rh))
+
+    def close(self):
+        self.datafile.close()
+
+
+class DlaSink:
+    """ Write the chunks of a pipelined download in a dla archive. """
+    def __init__(self, fn, dl120th):
+        print("Filename:", fn)
+        self.writer = dlformats.DlaWriter(
+            fn, dl120th.logger_name, int(dl120th.start_rec.strftime("%s")),
+            dl120th.interval, dl120th.temp_fahrenheit)
+
+    def write(self, first, temp, rh):
+        self.writer.write(temp, rh)
+
+    def close(self):
+        self.writer.close()
+
+
+class DbSink:
+    """
+    Insert the chunks of a pipelined download in the database, one
+    transaction per chunk. The data already stored are skipped.
+    """
+    def __init__(self, db, dl120th):
+        print("Database:", db)
+        self.dl120th = dl120th
+        self.conn = sensorsdb.connect(db)
+        self.watermark = sensorsdb.get_watermark(self.conn,
+                                                 dl120th.logger_name)
+        self.start = int(dl120th.start_rec.strftime("%s"))
+        self.new = 0
+
+    def write(self, first, temp, rh):
+        skipped, rows = sensorsdb.sample_rows(
+            self.dl120th.logger_name,
+            self.start + first * self.dl120th.interval,
+            self.dl120th.interval, temp, rh, self.watermark)
+        count, new = sensorsdb.insert_rows(self.conn, rows,
+                                           max(len(temp), 1))
+        self.new += new
+
+    def close(self):
+        # Excursions of the recording out of the alarms of the logger
+        name = self.dl120th.logger_name
+        sensorsdb.set_alarms(self.conn, name, self.dl120th.alarms())
+        if self.new:
+            dlalarms.scan_range(self.conn, name, self.start,
+                                sensorsdb.get_watermark(self.conn, name) + 1)
+        self.conn.close()
+        print("Data new:", self.new,
+              " skipped:", self.dl120th.num_data_rec - self.new)
+
+
+class Collector:
+    """
+    Keep the data loggers plugged in opened and save their data in the
+    database when they are nearly full or on schedule.
+    """
+    def __init__(self, get_devices, database, fill=0.9, every=None,
+                 rearm=False, new_logger=None, metrics_file=None):
+        # Function returning the (address, device) plugged in
+        self.get_devices = get_devices
+        # Function returning the Dl120th of a device from its address and
+        # its device
+        self.new_logger = new_logger or \
+            (lambda address, device: Dl120th(device, address=address))
+        self.database = database
+        # Fraction of the configured number of data triggering a download
+        self.fill = fill
+        # Seconds between two downloads, None to only download when full
+        self.every = every
+        # Restart the recording after each download
+        self.rearm = rearm
+        # Prometheus textfile of the metrics of the downloads, if any
+        self.metrics_file = metrics_file
+        # Opened loggers, time, recording (start, number of data) and
+        # metrics of their last download by address
+        self.loggers = {}
+        self.last_download = {}
+        self.downloaded = {}
+        self.last_metrics = {}
+
+    def scan(self):
+        """ Open the loggers plugged in since the last scan. """
+        for address, device in self.get_devices():
+            if address in self.loggers:
+                continue
+            try:
+                dl120th = self.new_logger(address, device)
+                open_logger(dl120th)
+            except Exception as err:
+                print("Logger", address, "not opened:", err)
+                continue
+            print("Logger", address, "plugged in:", dl120th.logger_name)
+            self.loggers[address] = dl120th
+            self.last_download[address] = time.time()
+
+    def drop(self, address):
+        """ Release a logger and forget it (unplugged or at exit). """
+        dl120th = self.loggers.pop(address)
+        del self.last_download[address]
+        self.downloaded.pop(address, None)
+        self.last_metrics.pop(address, None)
+        try:
+            dl120th.close()
+        except Exception as err:
+            print(err)
+        print("Logger", address, "released")
+
+    def poll(self, address):
+        """
+        Read the configuration of a logger and download its data if it is
+        nearly full or if its schedule is due, unless it recorded nothing
+        since its last download (a full logger that is not rearmed).
+        """
+        dl120th = self.loggers[address]
+        dl120th.read_config()
+        now = time.time()
+        recording = (dl120th.start_rec, dl120th.num_data_rec)
+        full = dl120th.num_data_rec >= self.fill * dl120th.num_data_conf
+        due = self.every is not None and \
+            now - self.last_download[address] >= self.every
+        if dl120th.num_data_rec == 0 or not (full or due) or \
+                recording == self.downloaded.get(address):
+            return
+
+        print("Logger", address, dl120th.logger_name, "download of",
+              dl120th.num_data_rec, "data")
+        dl120th.save_data_to_db(self.database)
+        self.last_download[address] = now
+        self.downloaded[address] = recording
+
+        if self.rearm:
+            dl120th.write_config(None, None, None, None)
+            dl120th.read_config()
+
+        # Report the metrics since the previous download
+        labels = {'logger': dl120th.logger_name, 'address': address}
+        print(dlmetrics.json_line(dl120th.metrics, **labels))
+        self.last_metrics[address] = (labels, dl120th.metrics)
+        if self.metrics_file is not None:
+            dlmetrics.write_prometheus(self.metrics_file,
+                                       list(self.last_metrics.values()))
+        dl120th.metrics = dlmetrics.Metrics()
+
+    def poll_all(self):
+        """
+        Scan and poll the loggers once. A logger failing (USB, database...)
+        is released, and opened again by the next scan if it is still
+        plugged in.
+        """
+        self.scan()
+        for address in list(self.loggers):
+            try:
+                self.poll(address)
+            except Exception as err:
+                print("Logger", address, "error:", err)
+                self.drop(address)
+
+    def run(self, poll=60):
+        """ Scan and poll the loggers every poll seconds, forever. """
+        try:
+            while True:
+                self.poll_all()
+                time.sleep(poll)
+        finally:
+            for address in list(self.loggers):
+                self.drop(address)
+
+
+def output_filename(dl120th, args):
+    """ Name of the file to store the data: --output or name_date.format """
+    if args.output is not None:
+        return args.output
+    return dl120th.logger_name.rstrip('\0') + "_" + \
+        dl120th.start_rec.strftime("%Y%m%d-%H%M%S") + "." + args.format
+
+
+def run_command(dl120th, args):
+    """ Run the command line command on an opened data logger. """
+    if args.command == 'config':
+        print(args.command, " Logger=", args.logname,
+              " numdata=", args.numdata, "@", args.interval, " sec. ")
+        dl120th.write_config(args.logname, args.numdata,
+                             args.interval, args.start)
+
+    if args.command == 'reset':
+        print(args.command, " Logger=", args.logname,
+              " numdata=", args.numdata, "@", args.interval, " sec. ")
+        dl120th.write_config(args.logname, args.numdata,
+                             args.interval, args.start)
+
+    if args.command == 'info':
+        dl120th.print_config()
+        if args.database is not None:
+            conn = sensorsdb.connect(args.database)
+            dlalarms.print_excursions(sensorsdb.get_excursions(
+                conn, dl120th.logger_name))
+            conn.close()
+
+    if args.command == 'print':
+        print(args.command)
+        dl120th.print_data()
+
+    if args.command == 'save':
+        # Sinks of the pipelined download
+        sinks = []
+        if args.database is not None:
+            print(args.command, " database=", args.database)
+            if args.pipeline:
+                sinks.append(DbSink(args.database, dl120th))
+            else:
+                dl120th.save_data_to_db(args.database)
+        if args.output is not None or args.database is None:
+            fn = output_filename(dl120th, args)
+            print(args.command, " output=", fn)
+            if args.pipeline and args.format == 'dla':
+                sinks.append(DlaSink(fn, dl120th))
+            elif args.pipeline:
+                sinks.append(DatSink(fn, dl120th))
+            elif args.format == 'bin':
+                dl120th.save_data_to_bin(fn)
+            elif args.format == 'dla':
+                dl120th.save_data_to_dla(fn)
+            else:
+                dl120th.save_data_to_file(fn)
+        if args.pipeline:
+            dl120th.download(sinks)
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(
@@ -385,7 +903,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '-c', '--command',
         help='Command for the data logger.',
-        choices=('info', 'save', 'reset', 'config', 'print'),
+        choices=('info', 'save', 'reset', 'config', 'print', 'daemon'),
         required=True)
     parser.add_argument(
         '-l', '--logname',
@@ -404,6 +922,79 @@ if __name__ == '__main__':
     parser.add_argument(
         '-o', '--output',
         help='Filename to store the data')
+    parser.add_argument(
+        '-F', '--format',
+        help='Format of the file to store the data: text (dat, default), '
+        'binary (bin) or compressed archive (dla).',
+        choices=('dat', 'bin', 'dla'), default='dat')
+    parser.add_argument(
+        '-d', '--database',
+        help='SQLite database to store the data (no file is written '
+        'unless --output is also given), info: show the excursions of the '
+        'logger stored in it.')
+    parser.add_argument(
+        '-p', '--pipeline',
+        help='Save: write the data (dat file and database) while they '
+        'are downloaded instead of after the download.',
+        action='store_true')
+    parser.add_argument(
+        '-e', '--emulate',
+        help='Use an emulated logger replaying a .dat capture '
+        '(or holding the given number of synthetic data), '
+        'can be repeated.',
+        action='append')
+    parser.add_argument(
+        '-a', '--all',
+        help='Use all the data loggers plugged in (info, print and save '
+        'only), they are downloaded concurrently.',
+        action='store_true')
+    parser.add_argument(
+        '-u', '--usb',
+        help='Address (bus:device) of the data logger to use.')
+    parser.add_argument(
+        '--poll',
+        help='Daemon: seconds between two reads of the configurations '
+        '(default 60).',
+        type=int, default=60)
+    parser.add_argument(
+        '--fill',
+        help='Daemon: download when the number of data recorded reaches '
+        'this fraction of the configured number (default 0.9).',
+        type=float, default=0.9)
+    parser.add_argument(
+        '--every',
+        help='Daemon: also download every EVERY seconds.',
+        type=int)
+    parser.add_argument(
+        '--rearm',
+        help='Daemon: restart the recording after each download.',
+        action='store_true')
+    parser.add_argument(
+        '--timeout',
+        help='Timeout of each USB transfer in milliseconds (default 1000).',
+        type=int, default=1000)
+    parser.add_argument(
+        '--retries',
+        help='Number of times a failed download is resumed in a row '
+        '(default 3).',
+        type=int, default=3)
+    parser.add_argument(
+        '--backoff',
+        help='Seconds before the first retry, doubled at each retry '
+        '(default 0.5).',
+        type=float, default=0.5)
+    parser.add_argument(
+        '--metrics',
+        help='Prometheus textfile collector file where the timings, '
+        'throughput, packets and retries of the sessions are written.')
+    parser.add_argument(
+        '--verbose',
+        help='Print the raw answers of the data logger.',
+        action='store_true')
+    parser.add_argument(
+        '-N', '--name',
+        help='Name of the data logger to use, as read from its '
+        'configuration.')
 
     args = parser.parse_args()
 
@@ -412,13 +1003,89 @@ if __name__ == '__main__':
     # print "Number of data", args.numdata
     # print "Interval", args.interval
 
-    # Initialization of the device
-    dl120th = Dl120th()
-    dl120th.open()
-    dl120th.read_config()
+    # Initialization of the devices
+    discovery = timer()
+    if args.emulate is None:
+        devices = Dl120th.device_descriptor.get_devices()
+    else:
+        from dl120emu import Dl120thEmulator
+        devices = []
+        for capture in args.emulate:
+            if capture.isdigit():
+                device = Dl120thEmulator.synthetic(int(capture))
+            else:
+                device = Dl120thEmulator.from_dat(capture)
+            devices.append(("emu:%i" % len(devices), device))
+    discovery = timer() - discovery
+
+    def new_logger(address, device):
+        dl120th = Dl120th(device, args.timeout, args.retries, args.backoff,
+                          address, args.verbose)
+        dl120th.metrics.add('discovery', discovery)
+        return dl120th
+
+    if args.command == 'daemon':
+        if args.database is None:
+            print("Database is mandatory in daemon mode.")
+            print("Command line error...")
+            sys.exit(2)
+
+        if args.emulate is None:
+            get_devices = Dl120th.device_descriptor.get_devices
+        else:
+            def get_devices():
+                return devices
+        collector = Collector(get_devices, args.database, args.fill,
+                              args.every, args.rearm, new_logger,
+                              args.metrics)
+        try:
+            collector.run(args.poll)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if args.usb is not None:
+        devices = [plugged for plugged in devices if plugged[0] == args.usb]
+    if not args.all and args.name is None:
+        devices = devices[:1]
+    if not devices:
+        print("Device isn't plugged in.")
+        sys.exit(1)
+
+    loggers = [new_logger(*plugged) for plugged in devices]
+    try:
+        open_loggers(loggers)
+    except (usb.USBError, IOError) as err:
+        print(err)
+        sys.exit(1)
+
+    if args.name is not None:
+        selected = []
+        for dl120th in loggers:
+            if dl120th.logger_name == args.name and \
+                    (args.all or not selected):
+                selected.append(dl120th)
+            else:
+                dl120th.close()
+        loggers = selected
+        if not loggers:
+            print("No data logger named", args.name)
+            sys.exit(1)
 
     commandOk = True
 
+    if len(loggers) > 1:
+        if args.command in ('config', 'reset'):
+            print("Only one data logger can be configured at a time.")
+            commandOk = False
+        if args.output is not None:
+            print("Output can't be used with several data loggers.")
+            commandOk = False
+
+    if args.pipeline and args.format == 'bin':
+        print("The bin format can't be written by a pipelined download.")
+        commandOk = False
+
     if args.command == 'config':
         if args.logname is None:
             print("Logname is mandatory in config mode.")
@@ -470,38 +1137,32 @@ if __name__ == '__main__':
 
     if not commandOk:
         print("Command line error...")
+        for dl120th in loggers:
+            dl120th.close()
         sys.exit(2)
 
-    if args.command == 'config':
-        print(args.command, " Logger=", args.logname,
-              " numdata=", args.numdata, "@", args.interval, " sec. ")
-        dl120th.write_config(args.logname, args.numdata,
-                             args.interval, args.start)
-
-    if args.command == 'reset':
-        print(args.command, " Logger=", args.logname,
-              " numdata=", args.numdata, "@", args.interval, " sec. ")
-        dl120th.write_config(args.logname, args.numdata,
-                             args.interval, args.start)
-
-    if args.command == 'info':
-        dl120th.print_config()
-
-    if args.command == 'print':
-        print(args.command)
-        dl120th.read_data()
-        dl120th.print_data()
-
-    if args.command == 'save':
-        dl120th.read_data()
-        if args.output is None:
-            fn = dl120th.logger_name.rstrip('\0') + "_" + \
-                dl120th.start_rec.strftime("%Y%m%d-%H%M%S") + ".dat"
+    try:
+        if args.command == 'save' and args.pipeline:
+            # Download and save each logger in one pass
+            for_each(lambda dl120th: run_command(dl120th, args), loggers)
         else:
-            fn = args.output
-        print(args.command, " output=", fn)
-        dl120th.save_data_to_file(fn)
-
-    dl120th.close()
-
-sys.exit(0)
+            if args.command in ('print', 'save'):
+                for_each(Dl120th.read_data, loggers)
+
+            for dl120th in loggers:
+                run_command(dl120th, args)
+    except (usb.USBError, IOError) as err:
+        print(err)
+        sys.exit(1)
+
+    entries = []
+    for dl120th in loggers:
+        dl120th.close()
+        labels = {'logger': dl120th.logger_name,
+                  'address': dl120th.address}
+        print(dlmetrics.json_line(dl120th.metrics, **labels))
+        entries.append((labels, dl120th.metrics))
+    if args.metrics is not None:
+        dlmetrics.write_prometheus(args.metrics, entries)
+
+    sys.exit(0)
@@ -0,0 +1,191 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# dl120emu - Emulate a Voltcraft DL-120TH data logger without USB
+#
+# Copyright 2015 Patrick Rabu
+
+import math
+import sys
+
+from array import array
+from datetime import datetime
+from struct import pack, unpack
+
+
+class EmulatedHandle:
+    """
+    Stand-in for the pyusb handle of an opened DL-120TH.
+    It answers the requests of the Dl120th class from the recording held
+    by the emulated logger.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        # Packets waiting to be read by bulkRead
+        self.pending = []
+        # Offset of the next data packet, None when no download is running
+        self.offset = None
+        # True when the next bulkWrite holds the configuration to write
+        self.config_pending = False
+
+    def claimInterface(self, interface_id):
+        pass
+
+    def releaseInterface(self):
+        pass
+
+    def reset(self):
+        self.pending = []
+        self.offset = None
+        self.config_pending = False
+
+    def bulkWrite(self, endpoint, buf, timeout=100):
+        if self.config_pending:
+            self.config_pending = False
+            self.logger.write_config(bytearray(buf))
+            self.pending.append((0xff, ))
+            return len(buf)
+
+        request = tuple(buf[:3])
+        if request == (0x00, 0x10, 0x01):
+            # Read configuration
+            self.pending.append((0x02, 0x40, 0x00))
+            self.pending.append(tuple(self.logger.config()))
+        elif request == (0x01, 0x40, 0x00):
+            # Write configuration, the configuration follows
+            self.config_pending = True
+        elif request == (0x00, 0x00, 0x40):
+            # Read data
+            self.pending.append((0x02, 0x00, 0x40))
+            self.offset = 0
+        elif request == (0x00, 0x01, 0x40):
+            # Keep alive
+            self.pending.append((0x02, 0x00, 0x40))
+        else:
+            raise IOError("Unknown request: %s" % (request, ))
+        return len(buf)
+
+    def bulkRead(self, endpoint, size, timeout=100):
+        if self.pending:
+            return self.pending.pop(0)
+        if self.offset is None:
+            raise IOError("Timeout: nothing to read")
+
+        index = self.offset // size
+        if index in self.logger.faults:
+            # Injected transfer failure, only once per packet
+            self.logger.faults.discard(index)
+            raise IOError("Timeout: injected failure at packet %i" % index)
+
+        packet = self.logger.packet(self.offset, size)
+        self.offset += size
+        return tuple(packet)
+
+
+class Dl120thEmulator:
+    """
+    Emulated DL-120TH usable in place of the pyusb device given to Dl120th.
+    The recording is either synthetic or replayed from a .dat capture.
+    """
+    VENDOR_ID = 0x10C4
+    PRODUCT_ID = 0x0003
+    CONFIG_FORMAT = "IIIIIhhhhBBBBBBB16sBhhhhI"
+
+    def __init__(self, name, start, interval, temp, rh,
+                 num_data_conf=16000, filename='001'):
+        self.idVendor = Dl120thEmulator.VENDOR_ID
+        self.idProduct = Dl120thEmulator.PRODUCT_ID
+        self.filename = filename
+        self.name = name
+        self.start = start
+        self.interval = interval
+        self.num_data_conf = num_data_conf
+        self.logger_start = 2
+        self.thresh_temp_low = 0x0000
+        self.thresh_temp_high = 0x4220
+        self.thresh_rh_low = 0x41A0
+        self.thresh_rh_high = 0x42A0
+        # Indexes of the data packets whose next read fails
+        self.faults = set()
+        self.set_recording(temp, rh)
+
+    @classmethod
+    def synthetic(cls, num_data, interval=2, name='emulated'):
+        """ Logger holding num_data samples of a daily cycle. """
+        temp = []
+        rh = []
+        for i in range(num_data):
+            phase = 2 * math.pi * i * interval / 86400.0
+            temp.append(int(200 + 50 * math.sin(phase)))
+            rh.append(int(550 - 100 * math.sin(phase)))
+        return cls(name, datetime(2015, 1, 1), interval, temp, rh)
+
+    @classmethod
+    def from_dat(cls, fn):
+        """ Logger replaying the recording saved in a .dat file. """
+        with open(fn) as datfile:
+            # "# name [YYYY-mm-dd HH:MM:SS] N points @ I sec"
+            words = datfile.readline().split()
+            name = words[1]
+            start = datetime.strptime(words[2] + " " + words[3],
+                                      "[%Y-%m-%d %H:%M:%S]")
+            interval = int(words[7])
+            temp = []
+            rh = []
+            for line in datfile:
+                words = line.split()
+                temp.append(int(round(float(words[3]) * 10)))
+                rh.append(int(round(float(words[4]) * 10)))
+        return cls(name, start, interval, temp, rh)
+
+    def set_recording(self, temp, rh):
+        """ Replace the recorded samples. """
+        self.num_data_rec = len(temp)
+        samples = array('h', [0] * (2 * self.num_data_rec))
+        samples[0::2] = array('h', temp)
+        samples[1::2] = array('h', rh)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        if hasattr(samples, 'tobytes'):
+            self.data = bytearray(samples.tobytes())
+        else:
+            self.data = bytearray(samples.tostring())
+
+    def open(self):
+        return EmulatedHandle(self)
+
+    def config(self):
+        """ Configuration block as sent by the logger. """
+        name = self.name
+        if not isinstance(name, bytes):
+            name = name.encode('ascii')
+        return bytearray(pack(Dl120thEmulator.CONFIG_FORMAT,
+                              0xce, self.num_data_conf, self.num_data_rec,
+                              self.interval, self.start.year, 0,
+                              self.thresh_temp_low, 0, self.thresh_temp_high,
+                              self.start.month, self.start.day,
+                              self.start.hour, self.start.minute,
+                              self.start.second, 0, 0, name,
+                              self.logger_start, 0, self.thresh_rh_low,
+                              0, self.thresh_rh_high, 0xce))
+
+    def write_config(self, buf):
+        """ Apply a configuration block and restart the recording. """
+        state, self.num_data_conf, num_data_rec, self.interval, \
+            year, padding1, self.thresh_temp_low, \
+            padding2, self.thresh_temp_high, \
+            month, mday, hour, minute, second, \
+            fahrenheit, led, name, self.logger_start, \
+            padding3, self.thresh_rh_low, \
+            padding4, self.thresh_rh_high, end = \
+            unpack(Dl120thEmulator.CONFIG_FORMAT, bytes(buf))
+        self.name = name.replace(b'\00', b'').decode('ascii')
+        self.start = datetime(year, month, mday, hour, minute, second)
+        self.set_recording([], [])
+
+    def packet(self, offset, size):
+        """ Data packet at offset, padded with zeros after the end. """
+        packet = self.data[offset:offset + size]
+        if len(packet) < size:
+            packet.extend(bytearray(size - len(packet)))
+        return packet
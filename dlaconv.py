@@ -0,0 +1,113 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# dlaconv - Convert the dat files of the Voltcraft DL-120TH to dla archives
+# and back.
+#
+# Copyright 2015 Patrick Rabu
+
+import argparse
+import glob
+import os
+import sys
+
+from timeit import default_timer as timer
+
+import dlformats
+
+
+def output_name(fn, outdir=None):
+    """
+    Name of the conversion of fn: .dla for a dat file, .dat for a dla
+    file, in outdir if given.
+    """
+    base, ext = os.path.splitext(fn)
+    if outdir is not None:
+        base = os.path.join(outdir, os.path.basename(base))
+    if dlformats.is_dla(fn):
+        return base + '.dat'
+    return base + '.dla'
+
+
+def convert(fn, output, block_size=dlformats.DLA_BLOCK_SIZE):
+    """
+    Convert the dat file fn to the dla archive output, or the dla archive
+    fn to the dat file output. Return the number of samples.
+    """
+    if dlformats.is_dla(fn):
+        return dlformats.dla_to_dat(fn, output)
+    return dlformats.dat_to_dla(fn, output, block_size)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Convert dat files to dla archives (header, then zlib '
+        'blocks of the deltas of the data) and dla archives to dat files.',
+        prog='dlaconv.py')
+    parser.add_argument(
+        '-f', '--filename',
+        help='Name of the dat or dla file, or glob pattern, can be '
+        'repeated.',
+        action='append')
+    parser.add_argument(
+        '-o', '--output',
+        help='Name of the converted file (one file only, default: name of '
+        'the file with the other extension).')
+    parser.add_argument(
+        '--outdir',
+        help='Directory of the converted files.')
+    parser.add_argument(
+        '-b', '--block-size', type=int, default=dlformats.DLA_BLOCK_SIZE,
+        help='Number of samples per block of the dla archives (default '
+        '%i).' % dlformats.DLA_BLOCK_SIZE)
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help='Only print the final report.')
+
+    args = parser.parse_args()
+
+    commandOk = True
+
+    files = []
+    if args.filename is None:
+        print("Filename is mandatory.")
+        commandOk = False
+    else:
+        for pattern in args.filename:
+            files.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    if args.output is not None and files and (args.outdir is not None or
+                                              len(files) != 1):
+        print("Output is only allowed with a single file and no outdir.")
+        commandOk = False
+
+    if args.block_size < 1:
+        print("Block size should be greater than 0.")
+        commandOk = False
+
+    if not commandOk:
+        print("Command line error...")
+        sys.exit(2)
+
+    start = timer()
+    total = 0
+    size_in = 0
+    size_out = 0
+    for fn in files:
+        output = args.output or output_name(fn, args.outdir)
+        count = convert(fn, output, args.block_size)
+        total += count
+        size_in += os.path.getsize(fn)
+        size_out += os.path.getsize(output)
+        if not args.quiet:
+            print("%s -> %s: %i samples, %i -> %i bytes" % (
+                fn, output, count, os.path.getsize(fn),
+                os.path.getsize(output)))
+    duration = timer() - start
+
+    print("%i files, %i samples converted in %.3f s: %i -> %i bytes "
+          "(%.1f %%)" % (len(files), total, duration, size_in, size_out,
+                         size_out * 100.0 / (size_in or 1)))
+
+    sys.exit(0)
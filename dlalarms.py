@@ -0,0 +1,210 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# dlalarms - Alarms of the Voltcraft DL-120TH and excursions of the data
+# out of them.
+#
+# Copyright 2015 Patrick Rabu
+
+import operator
+import time
+
+from itertools import chain
+from struct import pack, unpack
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import sensorsdb
+
+# Codes of the thresholds 0 to 100 in the configuration: high half of the
+# float32 of the threshold
+THRESHOLD = [
+    0x0000, 0x3F80, 0x4000, 0x4040, 0x4080, 0x40A0, 0x40C0, 0x40E0,
+    0x4100, 0x4110, 0x4120, 0x4130, 0x4140, 0x4150, 0x4160, 0x4170,
+    0x4180, 0x4188, 0x4190, 0x4198, 0x41A0, 0x41A8, 0x41B0, 0x41B8,
+    0x41C0, 0x41C8, 0x41D0, 0x41D8, 0x41E0, 0x41E8, 0x41F0, 0x41F8,
+    0x4200, 0x4204, 0x4208, 0x420C, 0x4210, 0x4214, 0x4218, 0x421C,
+    0x4220, 0x4224, 0x4228, 0x422C, 0x4230, 0x4234, 0x4238, 0x423C,
+    0x4240, 0x4244, 0x4248, 0x424C, 0x4250, 0x4254, 0x4258, 0x425C,
+    0x4260, 0x4264, 0x4268, 0x426C, 0x4270, 0x4274, 0x4278, 0x427C,
+    0x4280, 0x4282, 0x4284, 0x4286, 0x4288, 0x428A, 0x428C, 0x428E,
+    0x4290, 0x4292, 0x4294, 0x4296, 0x4298, 0x429A, 0x429C, 0x429E,
+    0x42A0, 0x42A2, 0x42A4, 0x42A6, 0x42A8, 0x42AA, 0x42AC, 0x42AE,
+    0x42B0, 0x42B2, 0x42B4, 0x42B6, 0x42B8, 0x42BA, 0x42BC, 0x42BE,
+    0x42C0, 0x42C2, 0x42C4, 0x42C6, 0x42C8]
+
+# Threshold of each code
+THRESHOLD_VALUES = dict((code, value)
+                        for value, code in enumerate(THRESHOLD))
+
+# Columns of the excursions
+EXCURSION_FIELDS = ('logger', 'quantity', 'kind', 'dtmin', 'date',
+                    'dtmax', 'duration', 'peak', 'threshold')
+
+
+def decode_threshold(code):
+    """
+    Threshold of a code of the configuration: looked up in
+    THRESHOLD_VALUES, or decoded as the high half of a float32 when it is
+    not an integer between 0 and 100.
+    """
+    code &= 0xffff
+    value = THRESHOLD_VALUES.get(code)
+    if value is None:
+        value = unpack('<f', pack('<HH', 0, code))[0]
+    return value
+
+
+def median_interval(times):
+    """ Median interval between the times, 0 if less than 2 times. """
+    if len(times) < 2:
+        return 0
+    if numpy is not None:
+        return float(numpy.median(numpy.diff(times)))
+    intervals = sorted(map(operator.sub, times[1:], times[:-1]))
+    return intervals[len(intervals) // 2]
+
+
+def find_excursions(times, values, low, high, interval):
+    """
+    Excursions of the values sampled at times (sorted epochs, every
+    interval seconds) below low or above high (None: no alarm), a gap of
+    more than 1.5 interval ending an excursion. With numpy, each alarm is
+    evaluated in one vectorized pass: runs of the mask of the values out of
+    range and peaks by reduceat.
+    Return a list of (kind 'low' or 'high', dtmin, dtmax, peak), dtmax
+    being the end of the last sample out of range.
+    """
+    gap = 1.5 * interval
+    alarms = [('low', low), ('high', high)]
+    excursions = []
+
+    if numpy is not None:
+        times = numpy.asarray(times)
+        values = numpy.asarray(values, dtype=float)
+        jumps = numpy.diff(times) > gap
+        for kind, limit in alarms:
+            if limit is None or not len(values):
+                continue
+            if kind == 'low':
+                mask = values < limit
+                peaks = numpy.minimum.reduceat
+                fill = numpy.inf
+            else:
+                mask = values > limit
+                peaks = numpy.maximum.reduceat
+                fill = -numpy.inf
+            # Runs: a sample out of range continues the run of the previous
+            # one unless there is a gap between them
+            cont = mask[1:] & mask[:-1] & ~jumps
+            first = numpy.flatnonzero(mask & ~numpy.append(False, cont))
+            if not len(first):
+                continue
+            last = numpy.flatnonzero(mask & ~numpy.append(cont, False))
+            excursions.extend(zip(
+                [kind] * len(first),
+                times[first].astype(int).tolist(),
+                (times[last] + interval).astype(int).tolist(),
+                peaks(numpy.where(mask, values, fill), first).tolist()))
+        return sorted(excursions, key=operator.itemgetter(1))
+
+    for kind, limit in alarms:
+        if limit is None:
+            continue
+        outside = operator.lt if kind == 'low' else operator.gt
+        best = min if kind == 'low' else max
+        # Running excursion: [dtmin, dt of its last sample, peak]
+        run = None
+        for dt, value in zip(times, values):
+            if run is not None and (dt - run[1] > gap or
+                                    not outside(value, limit)):
+                excursions.append((kind, int(run[0]),
+                                   int(run[1] + interval), run[2]))
+                run = None
+            if outside(value, limit):
+                if run is None:
+                    run = [dt, dt, value]
+                else:
+                    run[1] = dt
+                    run[2] = best(run[2], value)
+        if run is not None:
+            excursions.append((kind, int(run[0]), int(run[1] + interval),
+                               run[2]))
+    return sorted(excursions, key=operator.itemgetter(1))
+
+
+def logger_excursions(times, temp, hygro, alarms, interval):
+    """
+    Excursions of the temp and hygro sampled at times out of the alarms
+    (dictionary of sensorsdb.ALARMS), as (quantity, kind, dtmin, dtmax,
+    peak, threshold) by date.
+    """
+    excursions = []
+    for quantity, values in (('temp', temp), ('hygro', hygro)):
+        low = alarms.get(quantity + '_low')
+        high = alarms.get(quantity + '_high')
+        for kind, dtmin, dtmax, peak in find_excursions(times, values, low,
+                                                        high, interval):
+            threshold = low if kind == 'low' else high
+            excursions.append((quantity, kind, dtmin, dtmax,
+                               round(peak, 3), threshold))
+    return sorted(excursions, key=operator.itemgetter(2))
+
+
+def load_range(conn, logger, tmin, tmax):
+    """
+    Dates, temperatures and hygrometries of the logger between tmin and
+    tmax (float arrays with numpy, lists otherwise).
+    """
+    stmt = '''SELECT dt, temp, hygro FROM %s
+        WHERE logger = ? AND dt >= ? AND dt < ? ORDER BY dt'''
+    rows = chain.from_iterable(
+        conn.execute(stmt % sensors, (logger, tmin, tmax))
+        for sensors in sensorsdb.sensors_tables(conn, tmin, tmax))
+    if numpy is not None:
+        values = numpy.fromiter(chain.from_iterable(rows), dtype=float)
+        values = values.reshape(-1, 3)
+        return values[:, 0], values[:, 1], values[:, 2]
+
+    columns = list(zip(*rows))
+    if not columns:
+        return [], [], []
+    return list(columns[0]), list(columns[1]), list(columns[2])
+
+
+def scan_range(conn, logger, tmin, tmax, alarms=None, store=True):
+    """
+    Find the excursions of the logger between tmin and tmax out of alarms
+    (default: its stored alarms) and, if store is set, store them in place
+    of those of the range. Return them, as logger_excursions.
+    """
+    if alarms is None:
+        alarms = sensorsdb.get_alarms(conn, logger) or {}
+    times, temp, hygro = load_range(conn, logger, tmin, tmax)
+    excursions = logger_excursions(times, temp, hygro, alarms,
+                                   median_interval(times))
+    if store:
+        sensorsdb.store_excursions(conn, logger, tmin, tmax, excursions)
+    return excursions
+
+
+def excursion_row(logger, excursion):
+    """ Row of EXCURSION_FIELDS of an excursion. """
+    quantity, kind, dtmin, dtmax, peak, threshold = excursion
+    return (logger, quantity, kind, dtmin,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(dtmin)),
+            dtmax, dtmax - dtmin, peak, threshold)
+
+
+def print_excursions(excursions):
+    """ Print the excursions. """
+    print("Excursions:", len(excursions))
+    for quantity, kind, dtmin, dtmax, peak, threshold in excursions:
+        print("\t>%s %s %s -> %s (%i s) peak %s, alarm %s" % (
+            quantity, kind,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(dtmin)),
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(dtmax)),
+            dtmax - dtmin, peak, threshold))
@@ -0,0 +1,550 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# dlformats - File formats of the Voltcraft DL-120TH data.
+#
+# Copyright 2015 Patrick Rabu
+
+import calendar
+import mmap
+import sys
+import time
+import zlib
+
+from array import array
+from datetime import datetime, timedelta
+from itertools import islice
+from struct import Struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DAT_HEADER = "# %s [%s] %i points @ %i sec\n"
+
+# Binary format: header, then the temperatures and the relative humidities
+# of the samples as two columns of little endian int16 (tenth of unit)
+BIN_MAGIC = b'DL120BIN'
+BIN_VERSION = 1
+# magic, version, logger name, start (epoch), interval, number of samples,
+# fahrenheit flag, padding to 48 bytes
+BIN_HEADER = Struct('<8sH16sqIIB5x')
+
+# Archive format: header, then independent blocks of samples, each block
+# being a (first sample, number of samples, size) header followed by the
+# zlib compressed zigzag varints of the deltas of the temperatures then of
+# the relative humidities (tenth of unit)
+DLA_MAGIC = b'DL120DLA'
+DLA_VERSION = 1
+# magic, version, logger name, start (epoch), interval, number of samples,
+# fahrenheit flag, padding, samples per block
+DLA_HEADER = Struct('<8sH16sqIIBxI')
+DLA_BLOCK = Struct('<III')
+DLA_BLOCK_SIZE = 4096
+
+# "MM:SS" text of the seconds of an hour
+MINUTES_SECONDS = ["%02i:%02i" % divmod(seconds, 60)
+                   for seconds in range(3600)]
+
+
+def local_offset(wall):
+    """
+    Offset of the epoch of the naive local time wall (seconds since
+    1970-01-01 00:00:00 as if it were UTC), as computed by mktime.
+    """
+    return int(time.mktime(time.gmtime(wall)[:8] + (-1, ))) - wall
+
+
+def dat_timestamps(start, interval, count):
+    """
+    Timestamps of count samples taken every interval seconds from start
+    (naive local datetime), as written in the dat files: the text of
+    strftime("%s") and of strftime("%Y-%m-%d %H:%M:%S") of
+    start + timedelta(seconds=i * interval).
+    The wall clock times are an arithmetic sequence rendered one hour at a
+    time: a single date rendering per hour, and a single mktime unless the
+    offset changes inside the hour (zones with half hour or quarter hour
+    changes), the epochs of such an hour being computed for each sample.
+    Return two lists of strings.
+    """
+    epochs = []
+    datetimes = []
+    wall = calendar.timegm(start.timetuple())
+    end = wall + count * interval
+    while wall < end:
+        hour = wall // 3600
+        prefix = time.strftime("%Y-%m-%d %H:", time.gmtime(hour * 3600))
+
+        # Samples of this hour
+        hour_end = min(end, (hour + 1) * 3600)
+        last = wall + (hour_end - 1 - wall) // interval * interval
+        # mktime resolves the ambiguous times from its previous result: it
+        # is called in the order of the samples, the offset of the last
+        # sample of the hour being checked by localtime
+        offset = local_offset(wall)
+        if calendar.timegm(time.localtime(last + offset)) == last:
+            epochs.extend(map(str, range(wall + offset, hour_end + offset,
+                                         interval)))
+        else:
+            epochs.extend(str(dt + local_offset(dt))
+                          for dt in range(wall, hour_end, interval))
+        datetimes.extend(map(prefix.__add__,
+                             MINUTES_SECONDS[wall - hour * 3600:
+                                             hour_end - hour * 3600:
+                                             interval]))
+        wall = last + interval
+
+    return epochs, datetimes
+
+
+def tenths(values):
+    """
+    Text of value / 10.0 for each value (in tenth of unit), each distinct
+    value being rendered only once.
+    """
+    values = values.tolist()
+    texts = dict((value, str(value / 10.0)) for value in set(values))
+    return list(map(texts.__getitem__, values))
+
+
+def dat_header(name, start, interval, count):
+    """ Header line of a dat file. """
+    return DAT_HEADER % (name, start.strftime("%Y-%m-%d %H:%M:%S"),
+                         count, interval)
+
+
+def dat_text(start, interval, count, temp, rh):
+    """ Data lines of a dat file holding count samples. """
+    if count == 0:
+        return ""
+
+    epochs, datetimes = dat_timestamps(start, interval, count)
+    lines = map(" ".join, zip(epochs, datetimes,
+                              tenths(temp[:count]), tenths(rh[:count])))
+    return "\n".join(lines) + "\n"
+
+
+def write_dat(fn, name, start, interval, count, temp, rh):
+    """ Write count samples in the dat file fn. """
+    with open(fn, "w", 65536) as datafile:
+        datafile.writelines([dat_header(name, start, interval, count),
+                             dat_text(start, interval, count, temp, rh)])
+
+
+def int16_bytes(values):
+    """ Little endian int16 bytes of values (numpy or array('h')). """
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.astype('<i2').tobytes()
+
+    values = array('h', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+
+def int16_view(buf, offset, count):
+    """
+    count little endian int16 read from buf at offset, without copy when
+    possible (numpy, or memoryview on little endian Python 3 hosts).
+    """
+    if numpy is not None:
+        return numpy.frombuffer(buf, '<i2', count, offset)
+
+    if hasattr(memoryview, 'cast') and sys.byteorder == 'little':
+        return memoryview(buf)[offset:offset + 2 * count].cast('h')
+
+    values = array('h')
+    raw = buf[offset:offset + 2 * count]
+    if hasattr(values, 'frombytes'):
+        values.frombytes(raw)
+    else:
+        values.fromstring(raw)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class SampleSeries(object):
+    """
+    Regularly sampled values: the sample i was taken at
+    start + i * interval (epoch) and its value is raw[i] / scale.
+    raw is a typed array (numpy, array('h') or int16 view); the values
+    are only scaled on demand, in bulk.
+    """
+    __slots__ = ('start', 'interval', 'scale', 'raw')
+
+    def __init__(self, raw, start=0, interval=1, scale=10):
+        self.raw = raw
+        self.start = start
+        self.interval = interval
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, index):
+        """ Series of the samples of a slice (without step). """
+        first, last, step = index.indices(len(self.raw))
+        return SampleSeries(self.raw[first:max(first, last)],
+                            self.start + first * self.interval,
+                            self.interval, self.scale)
+
+    def times(self):
+        """ Epochs of the samples. """
+        if numpy is not None:
+            return self.start + \
+                numpy.arange(len(self.raw)) * self.interval
+        return list(range(self.start,
+                          self.start + len(self.raw) * self.interval,
+                          self.interval))
+
+    def values(self):
+        """ Values of the samples (raw / scale). """
+        if numpy is not None:
+            return numpy.asarray(self.raw) / float(self.scale)
+        return list(map(float(self.scale).__rtruediv__, self.raw))
+
+
+class BinRecording:
+    """
+    Recording loaded from a bin file (or a dla file).
+    temp and rh are SampleSeries of int16 views (tenth of unit) on the
+    memory mapped file (or of the decoded arrays).
+    """
+    def __init__(self, name, start, interval, count, fahrenheit, temp, rh):
+        self.name = name
+        self.start = start
+        self.interval = interval
+        self.count = count
+        self.fahrenheit = fahrenheit
+        self.temp = temp
+        self.rh = rh
+
+
+def write_bin(fn, name, start, interval, count, temp, rh, fahrenheit=0):
+    """
+    Write count samples in the bin file fn.
+    start is the epoch of the first sample.
+    """
+    if not isinstance(name, bytes):
+        name = name.encode('latin-1')
+    with open(fn, "wb") as binfile:
+        binfile.write(BIN_HEADER.pack(BIN_MAGIC, BIN_VERSION, name, start,
+                                      interval, count, fahrenheit))
+        binfile.write(int16_bytes(temp[:count]))
+        binfile.write(int16_bytes(rh[:count]))
+
+
+def is_bin(fn):
+    """ True if fn is a bin file. """
+    with open(fn, "rb") as binfile:
+        return binfile.read(len(BIN_MAGIC)) == BIN_MAGIC
+
+
+def load_bin(fn):
+    """ Memory map the bin file fn and return its BinRecording. """
+    with open(fn, "rb") as binfile:
+        buf = mmap.mmap(binfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, name, start, interval, count, fahrenheit = \
+        BIN_HEADER.unpack_from(buf, 0)
+    if magic != BIN_MAGIC or version != BIN_VERSION:
+        raise ValueError("%s is not a DL-120TH bin file" % fn)
+    name = name.rstrip(b'\0')
+    if not isinstance(name, str):
+        name = name.decode('latin-1')
+
+    offset = BIN_HEADER.size
+    return BinRecording(
+        name, start, interval, count, fahrenheit,
+        SampleSeries(int16_view(buf, offset, count), start, interval),
+        SampleSeries(int16_view(buf, offset + 2 * count, count),
+                     start, interval))
+
+
+def zigzag_varints(values):
+    """
+    Zigzag varint bytes of the deltas of the int16 values (the first one
+    being its own delta), 1 to 3 bytes per value.
+    """
+    if numpy is not None:
+        values = numpy.asarray(values, dtype=numpy.int32)
+        deltas = numpy.diff(numpy.append(numpy.int32(0), values))
+        zigzag = numpy.where(deltas >= 0, deltas * 2, -deltas * 2 - 1)
+        # Bytes of each varint and their positions
+        sizes = 1 + (zigzag >= 0x80) + (zigzag >= 0x4000)
+        starts = numpy.cumsum(sizes) - sizes
+        out = numpy.zeros(int(sizes.sum()), dtype=numpy.uint8)
+        out[starts] = (zigzag & 0x7f) | (sizes > 1) * 0x80
+        two = sizes > 1
+        out[starts[two] + 1] = ((zigzag[two] >> 7) & 0x7f) | \
+            (sizes[two] > 2) * 0x80
+        three = sizes > 2
+        out[starts[three] + 2] = zigzag[three] >> 14
+        return out.tobytes()
+
+    out = bytearray()
+    previous = 0
+    for value in values:
+        delta = int(value) - previous
+        previous = int(value)
+        zigzag = delta * 2 if delta >= 0 else -delta * 2 - 1
+        while zigzag >= 0x80:
+            out.append(zigzag & 0x7f | 0x80)
+            zigzag >>= 7
+        out.append(zigzag)
+    return bytes(out)
+
+
+def zigzag_deltas(buf):
+    """ Deltas (numpy int32 array or list) of the zigzag varints of buf. """
+    if numpy is not None:
+        raw = numpy.frombuffer(buf, dtype=numpy.uint8)
+        # Last byte of each varint
+        ends = numpy.flatnonzero(raw < 0x80)
+        if not len(ends):
+            return numpy.zeros(0, dtype=numpy.int32)
+        starts = numpy.append(0, ends[:-1] + 1)
+        sizes = ends - starts + 1
+        zigzag = (raw[starts] & 0x7f).astype(numpy.int32)
+        two = sizes > 1
+        zigzag[two] |= (raw[starts[two] + 1] & 0x7f).astype(numpy.int32) << 7
+        three = sizes > 2
+        zigzag[three] |= raw[starts[three] + 2].astype(numpy.int32) << 14
+        return numpy.where(zigzag & 1, -(zigzag >> 1) - 1, zigzag >> 1)
+
+    deltas = []
+    zigzag = 0
+    shift = 0
+    for byte in bytearray(buf):
+        zigzag |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            deltas.append(-(zigzag >> 1) - 1 if zigzag & 1 else zigzag >> 1)
+            zigzag = 0
+            shift = 0
+    return deltas
+
+
+def cumulate(deltas):
+    """ int16 values (numpy or array('h')) of their deltas. """
+    if numpy is not None:
+        return numpy.cumsum(deltas).astype(numpy.int16)
+
+    values = array('h')
+    value = 0
+    for delta in deltas:
+        value += delta
+        values.append(value)
+    return values
+
+
+def encode_block(temp, rh):
+    """ Compressed data of a block of the samples temp and rh. """
+    return zlib.compress(zigzag_varints(temp) + zigzag_varints(rh))
+
+
+def decode_block(data, count):
+    """ temp and rh (int16 arrays) of the count samples of a block. """
+    deltas = zigzag_deltas(zlib.decompress(data))
+    if len(deltas) != 2 * count:
+        raise ValueError("Corrupted dla block")
+    return cumulate(deltas[:count]), cumulate(deltas[count:])
+
+
+class DlaWriter:
+    """
+    Streaming writer of a dla file: the samples are given chunk by chunk
+    (tenth of unit) and written by blocks of block_size samples. The number
+    of samples of the header is written on close.
+    """
+    def __init__(self, fn, name, start, interval, fahrenheit=0,
+                 block_size=DLA_BLOCK_SIZE):
+        if not isinstance(name, bytes):
+            name = name.encode('latin-1')
+        self.name = name
+        self.start = start
+        self.interval = interval
+        self.fahrenheit = fahrenheit
+        self.block_size = block_size
+        self.count = 0
+        self.temp = []
+        self.rh = []
+        self.dlafile = open(fn, "wb")
+        self.write_header()
+
+    def write_header(self):
+        self.dlafile.write(DLA_HEADER.pack(
+            DLA_MAGIC, DLA_VERSION, self.name, self.start, self.interval,
+            self.count, self.fahrenheit, self.block_size))
+
+    def write(self, temp, rh):
+        """ Add samples, writing the full blocks. """
+        self.temp.extend(temp.tolist() if hasattr(temp, 'tolist')
+                         else temp)
+        self.rh.extend(rh.tolist() if hasattr(rh, 'tolist') else rh)
+        while len(self.temp) >= self.block_size:
+            self.write_block(self.block_size)
+
+    def write_block(self, count):
+        data = encode_block(self.temp[:count], self.rh[:count])
+        self.dlafile.write(DLA_BLOCK.pack(self.count, count, len(data)))
+        self.dlafile.write(data)
+        self.count += count
+        del self.temp[:count]
+        del self.rh[:count]
+
+    def close(self):
+        """ Write the last block and the number of samples. """
+        if self.temp:
+            self.write_block(len(self.temp))
+        self.dlafile.seek(0)
+        self.write_header()
+        self.dlafile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DlaReader:
+    """
+    Streaming reader of a dla file: header attributes as BinRecording,
+    blocks decoded one at a time.
+    """
+    def __init__(self, fn):
+        self.dlafile = open(fn, "rb")
+        header = self.dlafile.read(DLA_HEADER.size)
+        if len(header) != DLA_HEADER.size:
+            raise ValueError("%s is not a DL-120TH dla file" % fn)
+        magic, version, name, self.start, self.interval, self.count, \
+            self.fahrenheit, self.block_size = DLA_HEADER.unpack(header)
+        if magic != DLA_MAGIC or version != DLA_VERSION:
+            raise ValueError("%s is not a DL-120TH dla file" % fn)
+        name = name.rstrip(b'\0')
+        if not isinstance(name, str):
+            name = name.decode('latin-1')
+        self.name = name
+
+    def blocks(self, skip=0):
+        """
+        Generator of the blocks as (index of the first sample, temp, rh),
+        the blocks holding only samples before the index skip being
+        skipped without being decompressed.
+        """
+        self.dlafile.seek(DLA_HEADER.size)
+        while True:
+            header = self.dlafile.read(DLA_BLOCK.size)
+            if len(header) < DLA_BLOCK.size:
+                return
+            first, count, size = DLA_BLOCK.unpack(header)
+            if first + count <= skip:
+                self.dlafile.seek(size, 1)
+                continue
+            temp, rh = decode_block(self.dlafile.read(size), count)
+            yield first, temp, rh
+
+    def close(self):
+        self.dlafile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_dla(fn, name, start, interval, count, temp, rh, fahrenheit=0):
+    """
+    Write count samples in the dla file fn.
+    start is the epoch of the first sample.
+    """
+    with DlaWriter(fn, name, start, interval, fahrenheit) as writer:
+        writer.write(temp[:count], rh[:count])
+
+
+def is_dla(fn):
+    """ True if fn is a dla file. """
+    with open(fn, "rb") as dlafile:
+        return dlafile.read(len(DLA_MAGIC)) == DLA_MAGIC
+
+
+def load_dla(fn):
+    """ Decode the whole dla file fn and return its BinRecording. """
+    with DlaReader(fn) as reader:
+        temps = []
+        rhs = []
+        for first, temp, rh in reader.blocks():
+            temps.append(temp)
+            rhs.append(rh)
+
+    if numpy is not None:
+        temp = numpy.concatenate(temps or [numpy.zeros(0, numpy.int16)])
+        rh = numpy.concatenate(rhs or [numpy.zeros(0, numpy.int16)])
+    else:
+        temp = array('h')
+        rh = array('h')
+        for block in temps:
+            temp.extend(block)
+        for block in rhs:
+            rh.extend(block)
+    return BinRecording(
+        reader.name, reader.start, reader.interval, len(temp),
+        reader.fahrenheit, SampleSeries(temp, reader.start, reader.interval),
+        SampleSeries(rh, reader.start, reader.interval))
+
+
+def read_dat_header(datfile):
+    """
+    Read the header line of an opened dat file:
+    "# name [YYYY-mm-dd HH:MM:SS] N points @ I sec"
+    Return the logger name, the start (naive local datetime), the number
+    of samples and the interval.
+    """
+    words = datfile.readline().split()
+    start = datetime.strptime(words[2] + " " + words[3],
+                              "[%Y-%m-%d %H:%M:%S]")
+    return words[1], start, int(words[4]), int(words[7])
+
+
+def dat_to_dla(datfn, dlafn, block_size=DLA_BLOCK_SIZE):
+    """
+    Convert the dat file datfn to the dla file dlafn, block by block.
+    Return the number of samples.
+    """
+    with open(datfn) as datfile:
+        name, start, count, interval = read_dat_header(datfile)
+        with DlaWriter(dlafn, name, int(time.mktime(start.timetuple())),
+                       interval, 0, block_size) as writer:
+            while True:
+                rows = [line.split() for line in islice(datfile, block_size)]
+                if not rows:
+                    break
+                if not writer.count and not writer.temp:
+                    # The epoch of the first line is the start
+                    writer.start = int(rows[0][0])
+                writer.write([int(round(float(row[3]) * 10)) for row in rows],
+                             [int(round(float(row[4]) * 10)) for row in rows])
+    return writer.count
+
+
+def dla_to_dat(dlafn, datfn):
+    """
+    Convert the dla file dlafn to the dat file datfn, block by block.
+    Return the number of samples.
+    """
+    with DlaReader(dlafn) as reader:
+        start = datetime.fromtimestamp(reader.start)
+        with open(datfn, "w", 65536) as datfile:
+            datfile.write(dat_header(reader.name, start, reader.interval,
+                                     reader.count))
+            for first, temp, rh in reader.blocks():
+                datfile.write(dat_text(
+                    start + timedelta(seconds=first * reader.interval),
+                    reader.interval, len(temp), temp, rh))
+    return reader.count
@@ -0,0 +1,140 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# dlmetrics - Timing of the Voltcraft DL-120TH sessions and metrics export.
+#
+# Copyright 2015 Patrick Rabu
+
+import json
+import os
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer as timer
+
+# Phases of a session, in order
+PHASES = ('discovery', 'open', 'read_config', 'read_data', 'decode',
+          'save', 'close')
+
+PROMETHEUS_PREFIX = 'dl120th'
+
+
+class Metrics:
+    """
+    Durations in seconds of the phases of a data logger session, durations
+    of the stretches of the download between two keep alive messages and
+    counters of the transfer (bytes, packets and retries).
+    """
+    def __init__(self):
+        self.phases = {}
+        self.stretches = []
+        self.counters = {'bytes': 0, 'packets': 0, 'retries': 0}
+
+    def add(self, phase, seconds):
+        """ Add seconds to the duration of phase. """
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextmanager
+    def phase(self, phase):
+        """ Context timing a phase. """
+        start = timer()
+        try:
+            yield
+        finally:
+            self.add(phase, timer() - start)
+
+    def count(self, counter, value=1):
+        """ Add value to counter. """
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def bytes_per_sec(self):
+        """ USB throughput of the download. """
+        duration = self.phases.get('read_data', 0)
+        if duration <= 0:
+            return 0.0
+        return self.counters['bytes'] / duration
+
+    def summary(self, **labels):
+        """ Flat dictionary of the metrics and of the labels. """
+        result = dict(labels)
+        for phase, seconds in self.phases.items():
+            result[phase + '_seconds'] = round(seconds, 6)
+        result.update(self.counters)
+        result['bytes_per_sec'] = round(self.bytes_per_sec(), 1)
+        result['stretches'] = len(self.stretches)
+        result['stretch_max_seconds'] = round(max(self.stretches or [0]), 6)
+        return result
+
+
+def timed(phase):
+    """ Decorator timing a method of an object having a metrics attribute. """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.phase(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def json_line(metrics, **labels):
+    """ One line JSON summary of the metrics. """
+    return json.dumps(metrics.summary(**labels), sort_keys=True)
+
+
+def label_text(labels):
+    """ Prometheus text of a dictionary of labels. """
+    return ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in sorted(labels.items()))
+
+
+def prometheus_text(entries):
+    """
+    Prometheus exposition text of the metrics of the last session of each
+    logger, entries being a list of (labels, Metrics).
+    """
+    lines = []
+
+    def metric(name, kind, description, samples):
+        name = PROMETHEUS_PREFIX + '_' + name
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in samples:
+            lines.append("%s{%s} %s" % (name, label_text(labels),
+                                        repr(float(value))))
+
+    metric('phase_seconds', 'gauge',
+           'Duration of the phases of the last session.',
+           [(dict(labels, phase=phase), metrics.phases[phase])
+            for labels, metrics in entries
+            for phase in PHASES if phase in metrics.phases])
+    metric('stretch_max_seconds', 'gauge',
+           'Longest stretch of the last download between two keep alive.',
+           [(labels, max(metrics.stretches or [0]))
+            for labels, metrics in entries])
+    metric('bytes_per_second', 'gauge',
+           'USB throughput of the last download.',
+           [(labels, metrics.bytes_per_sec()) for labels, metrics in entries])
+    for counter in ('bytes', 'packets', 'retries'):
+        metric(counter + '_total', 'counter',
+               'Number of %s of the last download (reset by each session).'
+               % counter,
+               [(labels, metrics.counters[counter])
+                for labels, metrics in entries])
+    metric('last_session_timestamp_seconds', 'gauge',
+           'Time of the end of the last session.',
+           [(labels, time.time()) for labels, metrics in entries])
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(fn, entries):
+    """
+    Write the metrics in fn for the textfile collector of the Prometheus
+    node exporter. The file is replaced atomically.
+    """
+    tmp = fn + '.tmp'
+    with open(tmp, 'w') as textfile:
+        textfile.write(prometheus_text(entries))
+    os.rename(tmp, fn)
@@ -6,142 +6,648 @@
 # Copyright 2012 Patrick Rabu
 
 import argparse
+import hashlib
+import os
+import shutil
 import sys
-import sqlite3
 import locale
 
 import datetime
+from multiprocessing import Pool
 from time import strftime, localtime
 
+import matplotlib
+# Figures are only saved to files
+matplotlib.use('Agg')
+
 from matplotlib import pyplot
 from matplotlib import dates as mdates
 from matplotlib.dates import epoch2num
 
+import numpy
 
-if __name__ == '__main__':
+import dlformats
+import sensorsdb
 
-    parser = argparse.ArgumentParser(
-        description='Copy content of dat file into sqlite DB.',
-        prog='plotdb.py')
-    parser.add_argument(
-        '-m', '--month',
-        help='Month to plot data.')
-    parser.add_argument(
-        '-o', '--output',
-        help='Name of the output file.')
-    parser.add_argument(
-        '-d', '--database',
-        help='Name of the database file.')
+# Size of the figure in inches and its resolution (dots per inch)
+FIGSIZE = (9, 6)
+DPI = 100
 
-    args = parser.parse_args()
+# Limits of the temperature and hygrometry axes
+TEMP_LIMITS = (10, 35)
+HYGRO_LIMITS = (35, 75)
 
-    print("Month=", args.month)
-    print("Output=", args.output)
-    print("Database=", args.database)
+# Version of the figures of the plot cache, to change with plot()
+CACHE_VERSION = 1
 
-    if args.database is None:
-        database = 'sensors.db'
-    else:
-        database = args.database
+# Suffix of the file holding the key (see figure_key) of a figure plotted
+# in batch mode, next to it
+KEY_SUFFIX = '.key'
 
-    if args.output is None:
-        output = args.month + '.png'
-    else:
-        output = args.output
 
-    ymin = int(args.month[0:4])
-    mmin = int(args.month[4:6])
+def year_range(year):
+    """ First day of the year YYYY and first day of the next one. """
+    return datetime.datetime(int(year), 1, 1), \
+        datetime.datetime(int(year) + 1, 1, 1)
+
+
+def month_range(month):
+    """ First day of the month YYYYMM and first day of the next one. """
+    ymin = int(month[0:4])
+    mmin = int(month[4:6])
     ymax = ymin
     mmax = mmin + 1
     if mmax > 12:
         ymax += 1
         mmax = 1
 
-    dtmin = datetime.datetime(ymin, mmin, 1)
-    print("Date mini=", dtmin)
-    dtmax = datetime.datetime(ymax, mmax, 1)
-    print("Date maxi=", dtmax)
+    return datetime.datetime(ymin, mmin, 1), datetime.datetime(ymax, mmax, 1)
 
-    locale.setlocale(locale.LC_TIME, '')
-    titre = dtmin.strftime("Releves de %B %Y")
-    print(titre)
 
-    # first logger
-    dates0 = []
-    temp0 = []
-    hygro0 = []
-    # Second logger
-    dates1 = []
-    temp1 = []
-    hygro1 = []
-
-    # stmt = '''
-    # SELECT logger, datetime(dt, \'unixepoch\', \'localtime\'), temp, hygro
-    stmt = '''SELECT logger, dt, temp, hygro
-        from sensors
-        where dt >= ? and dt < ?;'''
-
-    conn = sqlite3.connect(database)
-
-    c = conn.cursor()
-
-    for row in c.execute(stmt, (dtmin.strftime("%s"), dtmax.strftime("%s"))):
-        if row[0] == 'rdc':
-            dates0.append(float(row[1]))
-            temp0.append(row[2])
-            hygro0.append(row[3])
+class Series:
+    """
+    Data of a logger to plot, dates being epochs.
+    When downsampled, the dates are the first date of each bucket, temp and
+    hygro the mean of the bucket and the *_min / *_max its extrema.
+    """
+    def __init__(self, logger, dates, temp, hygro, temp_min=None,
+                 temp_max=None, hygro_min=None, hygro_max=None):
+        self.logger = logger
+        self.dates = dates
+        self.temp = temp
+        self.hygro = hygro
+        self.temp_min = temp_min
+        self.temp_max = temp_max
+        self.hygro_min = hygro_min
+        self.hygro_max = hygro_max
+
+
+def fetch_values(cursor, size=4096):
+    """
+    Float array of the values of the rows of the cursor, NULL values being
+    NaN. The rows are fetched by size, so that only one chunk of them is
+    held in a list at a time.
+    """
+    chunks = []
+    rows = cursor.fetchmany(size)
+    while rows:
+        chunks.append(numpy.array(rows, dtype=float).ravel())
+        rows = cursor.fetchmany(size)
+    if len(chunks) == 1:
+        return chunks[0]
+    return numpy.concatenate(chunks or [numpy.zeros(0)])
+
+
+def rows_to_series(logger, values, width):
+    """
+    Series from the float array of the values of (dt, temp, hygro) rows
+    or downsampled (dt, temp, temp_min, temp_max, hygro, hygro_min,
+    hygro_max) rows (see fetch_values), width being the number of columns.
+    """
+    columns = values.reshape(-1, width).T
+    if width == 3:
+        return Series(logger, *columns)
+
+    dates, temp, temp_min, temp_max, hygro, hygro_min, hygro_max = columns
+    return Series(logger, dates, temp, hygro,
+                  temp_min, temp_max, hygro_min, hygro_max)
+
+
+def months_between(first, last):
+    """ Months YYYYMM from first to last included. """
+    year, month = int(first[0:4]), int(first[4:6])
+    months = []
+    while "%04i%02i" % (year, month) <= last:
+        months.append("%04i%02i" % (year, month))
+        month += 1
+        if month > 12:
+            year += 1
+            month = 1
+    return months
+
+
+def db_months(database):
+    """ Months YYYYMM (local time) holding data in the database. """
+    conn = sensorsdb.connect(database)
+    months = [row[0] for row in conn.execute(
+        '''SELECT DISTINCT strftime('%Y%m', dt, 'unixepoch', 'localtime')
+        FROM sensors_hourly ORDER BY 1''')]
+    conn.close()
+    return months
+
+
+def load_db(database, dtmin, dtmax, points=None, loggers=None):
+    """
+    Series recorded between dtmin and dtmax in the sensors table (or in
+    the partitions overlapping the range), one per logger (all the loggers
+    if not given), each one read by an indexed query on (logger, dt).
+    When points is given, the range is cut in points buckets aggregated by
+    SQLite (mean, min and max) so that at most points dates are returned,
+    from the coarsest rollup table whose period fits in a bucket.
+    Return a list of Series.
+    """
+    tmin = int(dtmin.strftime("%s"))
+    tmax = int(dtmax.strftime("%s"))
+
+    if points:
+        bucket = max(1, -((tmin - tmax) // points))
+        source = None
+        for table, period in sensorsdb.ROLLUPS:
+            if period <= bucket:
+                source = table
+
+        if source is None:
+            stmt = '''SELECT min(dt), avg(temp), min(temp), max(temp),
+                avg(hygro), min(hygro), max(hygro)
+                FROM %s
+                WHERE logger = ? AND dt >= ? AND dt < ?
+                GROUP BY dt / ?'''
         else:
-            dates1.append(float(row[1]))
-            temp1.append(row[2])
-            hygro1.append(row[3])
-        # print row[0].encode('ascii'), ' ', row[1], ' ', row[2], ' ', row[3]
+            stmt = '''SELECT min(dt), sum(temp_sum) / sum(count),
+                min(temp_min), max(temp_max), sum(hygro_sum) / sum(count),
+                min(hygro_min), max(hygro_max)
+                FROM %s
+                WHERE logger = ? AND dt >= ? AND dt < ?
+                GROUP BY dt / ?'''
+        params = (tmin, tmax, bucket)
+        width = 7
+    else:
+        stmt = '''SELECT dt, temp, hygro
+            FROM %s
+            WHERE logger = ? AND dt >= ? AND dt < ?
+            ORDER BY dt'''
+        params = (tmin, tmax)
+        width = 3
+        source = None
+
+    conn = sensorsdb.connect(database)
+    if loggers is None:
+        loggers = sensorsdb.get_loggers(conn)
+    if source is None:
+        # The sensors table or only the overlapping partitions
+        tables = sensorsdb.sensors_tables(conn, tmin, tmax)
+    else:
+        tables = [source]
 
-    # print dates
-    # print temp
-    # print hygro
-    # lineChart('plotdb.png', temp, hygro)
+    # Each partition is read for every logger while it is attached
+    values = dict((logger, []) for logger in loggers)
+    for table in tables:
+        for logger in loggers:
+            values[logger].append(fetch_values(
+                conn.execute(stmt % table, (logger, ) + params)))
+
+    series = []
+    for logger in loggers:
+        if len(values[logger]) == 1:
+            logger_values = values[logger][0]
+        else:
+            logger_values = numpy.concatenate(values[logger] or
+                                              [numpy.zeros(0)])
+        series.append(rows_to_series(logger, logger_values, width))
 
     conn.close()
 
-    # Matplotlib date format
-    dfmt = mdates.DateFormatter('%d')
+    return series
+
+
+def fingerprint(conn, tmin, tmax, loggers):
+    """
+    Cheap fingerprint of the data of the loggers between tmin and tmax:
+    the number of rows (from the hourly rollup) and the last dt (from the
+    index) of each logger. The rows are only ever added, so that it
+    changes with any insert in the range.
+    """
+    rollup, period = sensorsdb.ROLLUPS[0]
+    result = []
+    for logger in loggers:
+        count = conn.execute(
+            'SELECT sum(count) FROM %s WHERE logger = ? AND dt >= ? '
+            'AND dt < ?' % rollup,
+            (logger, tmin // period * period, tmax)).fetchone()[0]
+        last = None
+        for table in sensorsdb.sensors_tables(conn, tmin, tmax):
+            dt = conn.execute(
+                'SELECT max(dt) FROM %s WHERE logger = ? AND dt >= ? '
+                'AND dt < ?' % table, (logger, tmin, tmax)).fetchone()[0]
+            if dt is not None:
+                last = dt
+        result.append((logger, count, last))
+    return result
+
+
+def downsample(series, points):
+    """
+    Cut a regularly sampled series in at most points buckets of
+    consecutive samples and keep the mean, min and max of each bucket.
+    """
+    size = -(-len(series.dates) // points)
+    if size <= 1:
+        return series
 
+    starts = numpy.arange(0, len(series.dates), size)
+    counts = numpy.diff(numpy.append(starts, len(series.dates)))
+    return Series(series.logger, series.dates[starts],
+                  numpy.add.reduceat(series.temp, starts) / counts,
+                  numpy.add.reduceat(series.hygro, starts) / counts,
+                  numpy.minimum.reduceat(series.temp, starts),
+                  numpy.maximum.reduceat(series.temp, starts),
+                  numpy.minimum.reduceat(series.hygro, starts),
+                  numpy.maximum.reduceat(series.hygro, starts))
+
+
+def load_files(filenames, dtmin=None, dtmax=None, points=None):
+    """
+    Series recorded between dtmin and dtmax (the whole recordings if not
+    given) in the bin files, the data being read from the memory mapped
+    files, or in the dla archives. When points is given, each series is
+    downsampled to at most points buckets. Return a list of Series.
+    """
+    series = []
+    for fn in filenames:
+        if dlformats.is_dla(fn):
+            recording = dlformats.load_dla(fn)
+        else:
+            recording = dlformats.load_bin(fn)
+        first = 0
+        last = recording.count
+        if dtmin is not None:
+            tmin = int(dtmin.strftime("%s"))
+            first = max(first, -((recording.start - tmin) //
+                                 recording.interval))
+        if dtmax is not None:
+            tmax = int(dtmax.strftime("%s"))
+            last = min(last, -((recording.start - tmax) //
+                               recording.interval))
+        last = max(first, last)
+
+        temp = recording.temp[first:last]
+        logger_series = Series(recording.name, temp.times(), temp.values(),
+                               recording.rh[first:last].values())
+        if points:
+            logger_series = downsample(logger_series, points)
+        series.append(logger_series)
+    return series
+
+
+def set_date_axis(ax, dtmin, dtmax):
+    """ Ticks and limits of the date axis, by day or by month. """
+    if dtmax - dtmin > datetime.timedelta(days=62):
+        # Un trait par mois
+        ax.xaxis.set_major_locator(mdates.MonthLocator())
+        # Un trait par semaine
+        ax.xaxis.set_minor_locator(mdates.WeekdayLocator())
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%m'))
+    else:
+        # Un trait par jour
+        ax.xaxis.set_major_locator(mdates.DayLocator())
+        # Un trait toutes les 6 heures
+        ax.xaxis.set_minor_locator(mdates.HourLocator(interval=6))
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%d'))
+    ax.set_xlim(dtmin, dtmax)
+
+
+def plot(series, dtmin, dtmax, titre, output):
+    """ Plot the temperatures and hygrometries of the series in output. """
     # Creation of the figure 9 inches x 6 inches
-    fig = pyplot.figure(figsize=(9, 6))
+    fig = pyplot.figure(figsize=FIGSIZE, dpi=DPI)
     # fig, (ax0, ax1) = pyplot.subplots(nrows=2, sharex=True)
 
     # ax0 = fig.add_subplot(111)
     ax0 = pyplot.subplot(2, 1, 1)
-    # Un trait par jour
-    ax0.xaxis.set_major_locator(mdates.DayLocator())
-    # Un trait toutes les 6 heures
-    ax0.xaxis.set_minor_locator(mdates.HourLocator(interval=6))
-    ax0.xaxis.set_major_formatter(dfmt)
-    ax0.set_xlim(dtmin, dtmax)
-    ax0.set_ylim(10, 35)
-    ax0.plot_date(epoch2num(dates0), temp0, '-', xdate=True)
-    ax0.plot_date(epoch2num(dates1), temp1, '-', xdate=True)
+    set_date_axis(ax0, dtmin, dtmax)
+    ax0.set_ylim(*TEMP_LIMITS)
+    for logger_series in series:
+        dates = epoch2num(logger_series.dates)
+        line = ax0.plot_date(dates, logger_series.temp, '-', xdate=True,
+                             label=logger_series.logger)
+        if logger_series.temp_min is not None:
+            ax0.fill_between(dates, logger_series.temp_min,
+                             logger_series.temp_max, linewidth=0,
+                             color=line[0].get_color(), alpha=0.3)
     ax0.grid(True)
+    ax0.legend(loc='upper right', fontsize='small')
     # ax0.set_title(dtmin.strftime("Températures de %B %Y"))
     pyplot.ylabel("Températures")
     pyplot.title(titre)
 
     ax1 = pyplot.subplot(2, 1, 2)
-    # Un trait par jour
-    ax1.xaxis.set_major_locator(mdates.DayLocator())
-    # Un trait toutes les 6 heures
-    ax1.xaxis.set_minor_locator(mdates.HourLocator(interval=6))
-    ax1.xaxis.set_major_formatter(dfmt)
-    ax1.set_xlim(dtmin, dtmax)
-    ax1.set_ylim(35, 75)
-    ax1.plot_date(epoch2num(dates0), hygro0, '-', xdate=True)
-    ax1.plot_date(epoch2num(dates1), hygro1, '-', xdate=True)
+    set_date_axis(ax1, dtmin, dtmax)
+    ax1.set_ylim(*HYGRO_LIMITS)
+    for logger_series in series:
+        dates = epoch2num(logger_series.dates)
+        line = ax1.plot_date(dates, logger_series.hygro, '-', xdate=True)
+        if logger_series.hygro_min is not None:
+            ax1.fill_between(dates, logger_series.hygro_min,
+                             logger_series.hygro_max, linewidth=0,
+                             color=line[0].get_color(), alpha=0.3)
     ax1.grid(True)
     pyplot.ylabel("Hygrométrie")
-    pyplot.xlabel('Jours')
+    if dtmax - dtmin > datetime.timedelta(days=62):
+        pyplot.xlabel('Mois')
+    else:
+        pyplot.xlabel('Jours')
 
     #fig.set_title(titre)
     fig.autofmt_xdate()
-    pyplot.savefig(output)
+    pyplot.savefig(output, dpi=DPI)
+    pyplot.close(fig)
+
+
+class PlotCache:
+    """
+    Directory of rendered figures named by the sha1 of their parameters
+    and of the fingerprint of their data, holding at most max_bytes: the
+    least recently used figures (oldest modification time) are removed
+    first.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.evict()
+
+    def fetch(self, key, output):
+        """
+        Copy the cached figure key to output.
+        Return False if it is not cached.
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            os.utime(path, None)
+            shutil.copyfile(path, output)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def store(self, key, fn):
+        """ Copy the rendered figure fn in the cache, then evict. """
+        tmp = os.path.join(self.directory, '%s.%i.tmp' % (key, os.getpid()))
+        shutil.copyfile(fn, tmp)
+        os.rename(tmp, os.path.join(self.directory, key))
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used figures beyond max_bytes. """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def figure_key(conn, dtmin, dtmax, points, loggers, titre):
+    """
+    Key of the figure of the series of the database between dtmin and
+    dtmax: sha1 of its parameters and of the fingerprint of its data.
+    """
+    tmin = int(dtmin.strftime("%s"))
+    tmax = int(dtmax.strftime("%s"))
+    names = sensorsdb.get_loggers(conn) if loggers is None else loggers
+    data = fingerprint(conn, tmin, tmax, names)
+    return hashlib.sha1(repr((CACHE_VERSION, tmin, tmax, names, points,
+                              titre, FIGSIZE, DPI, TEMP_LIMITS,
+                              HYGRO_LIMITS, data)).encode('utf-8')).hexdigest()
+
+
+def plot_db(database, dtmin, dtmax, points, loggers, titre, output,
+            cache=None, key=None):
+    """
+    Plot the series of the database between dtmin and dtmax in output.
+    With a PlotCache, the figure is only rendered when its key (see
+    figure_key, computed if not given) is not cached, else it is copied
+    from the cache.
+    Return True if the figure was rendered.
+    """
+    if cache is not None:
+        if key is None:
+            conn = sensorsdb.connect(database)
+            key = figure_key(conn, dtmin, dtmax, points, loggers, titre)
+            conn.close()
+        key += os.path.splitext(output)[1]
+        if cache.fetch(key, output):
+            return False
+
+    series = load_db(database, dtmin, dtmax, points, loggers)
+    plot(series, dtmin, dtmax, titre, output)
+    if cache is not None:
+        cache.store(key, output)
+    return True
+
+
+def month_title(dtmin):
+    """ Title of the figure of a month. """
+    return dtmin.strftime("Releves de %B %Y")
+
+
+def read_key(output):
+    """ Key of the figure output plotted in batch mode, None if none. """
+    try:
+        with open(output + KEY_SUFFIX) as keyfile:
+            return keyfile.read().strip()
+    except IOError:
+        return None
+
+
+def plot_month(job):
+    """
+    Plot a month of the database, job being
+    (database, month, output, points, loggers, cache, key), and write its
+    key next to it. Used by the worker processes of the batch mode.
+    Return the output and whether it was rendered (see plot_db).
+    """
+    database, month, output, points, loggers, cache, key = job
+    dtmin, dtmax = month_range(month)
+    rendered = plot_db(database, dtmin, dtmax, points, loggers,
+                       month_title(dtmin), output, cache, key)
+    with open(output + KEY_SUFFIX, 'w') as keyfile:
+        keyfile.write(key + '\n')
+    return output, rendered
+
+
+def plot_months(database, months, directory, points, loggers, jobs=None,
+                force=False, cache=None):
+    """
+    Plot each month in directory/YYYYMM.png with a pool of jobs processes
+    (through the PlotCache cache if given).
+    The months whose key (see figure_key: parameters, number of rows and
+    last date of each logger in the month) did not change since they were
+    plotted are skipped unless force is set.
+    Return the list of the plotted files and whether they were rendered or
+    copied from the cache.
+    """
+    conn = sensorsdb.connect(database)
+    todo = []
+    for month in months:
+        output = os.path.join(directory, month + '.png')
+        dtmin, dtmax = month_range(month)
+        key = figure_key(conn, dtmin, dtmax, points, loggers,
+                         month_title(dtmin))
+        if not force and os.path.exists(output) and \
+                read_key(output) == key:
+            continue
+        todo.append((database, month, output, points, loggers, cache, key))
+    conn.close()
+
+    if not todo:
+        return []
+
+    pool = Pool(jobs)
+    try:
+        return pool.map(plot_month, todo, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Copy content of dat file into sqlite DB.',
+        prog='plotdb.py')
+    parser.add_argument(
+        '-m', '--month',
+        help='Month to plot data (YYYYMM), a range of months to plot in '
+        'batch (YYYYMM-YYYYMM) or all the months of the database (all).')
+    parser.add_argument(
+        '-y', '--year',
+        help='Year to plot data (instead of a month).')
+    parser.add_argument(
+        '-o', '--output',
+        help='Name of the output file.')
+    parser.add_argument(
+        '-d', '--database',
+        help='Name of the database file.')
+    parser.add_argument(
+        '-f', '--file',
+        help='Plot the data of a bin (or dla) file instead of the '
+        'database, can be repeated.',
+        action='append')
+    parser.add_argument(
+        '-p', '--points',
+        help='Number of buckets (min, mean and max) the data are reduced '
+        'to, 0 to plot every data (default: width of the figure '
+        'in pixels).',
+        type=int, default=FIGSIZE[0] * DPI)
+    parser.add_argument(
+        '-l', '--logger',
+        help='Logger to plot (default: all), can be repeated.',
+        action='append')
+    parser.add_argument(
+        '-j', '--jobs',
+        help='Number of processes plotting the months in batch mode '
+        '(default: number of CPUs).',
+        type=int)
+    parser.add_argument(
+        '--outdir',
+        help='Directory of the YYYYMM.png files in batch mode.',
+        default='.')
+    parser.add_argument(
+        '--force',
+        help='Plot the months in batch mode even if their data did not '
+        'change since they were plotted.',
+        action='store_true')
+    parser.add_argument(
+        '--cache-dir',
+        help='Directory of the cache of the figures plotted from the '
+        'database: a figure whose parameters and data did not change is '
+        'copied from it instead of being plotted again.')
+    parser.add_argument(
+        '--cache-size',
+        help='Maximum size of the cache in MiB (default 100), the least '
+        'recently used figures being removed.',
+        type=int, default=100)
+
+    args = parser.parse_args()
+
+    print("Month=", args.month)
+    print("Year=", args.year)
+    print("Output=", args.output)
+    print("Database=", args.database)
+
+    period = args.month or args.year
+    if period is None and (args.file is None or args.output is None):
+        print("Month is mandatory unless files and output are given.")
+        sys.exit(2)
+
+    if args.database is None:
+        database = 'sensors.db'
+    else:
+        database = args.database
+
+    if args.cache_dir is None:
+        cache = None
+    else:
+        cache = PlotCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    if args.month is not None and \
+            (args.month == 'all' or '-' in args.month):
+        # Batch mode
+        locale.setlocale(locale.LC_TIME, '')
+        if args.month == 'all':
+            months = db_months(database)
+        else:
+            first, last = args.month.split('-')
+            months = months_between(first, last)
+        print("Months=", len(months))
+        for output, rendered in plot_months(database, months, args.outdir,
+                                            args.points, args.logger,
+                                            args.jobs, args.force, cache):
+            if rendered:
+                print(output)
+            else:
+                print(output, "(cache)")
+        sys.exit(0)
+
+    if args.output is None:
+        output = period + '.png'
+    else:
+        output = args.output
+
+    if args.month is not None:
+        dtmin, dtmax = month_range(args.month)
+    elif args.year is not None:
+        dtmin, dtmax = year_range(args.year)
+    else:
+        dtmin, dtmax = None, None
+
+    if args.file is not None:
+        series = load_files(args.file, dtmin, dtmax, args.points)
+        if dtmin is None:
+            dtmin = datetime.datetime.fromtimestamp(
+                min(s.dates[0] for s in series if len(s.dates)))
+            dtmax = datetime.datetime.fromtimestamp(
+                max(s.dates[-1] for s in series if len(s.dates)))
+
+    print("Date mini=", dtmin)
+    print("Date maxi=", dtmax)
+
+    locale.setlocale(locale.LC_TIME, '')
+    if args.month is None and args.year is not None:
+        titre = dtmin.strftime("Releves de %Y")
+    else:
+        titre = month_title(dtmin)
+    print(titre)
+
+    if args.file is not None:
+        plot(series, dtmin, dtmax, titre, output)
+    elif not plot_db(database, dtmin, dtmax, args.points, args.logger,
+                     titre, output, cache):
+        print("From cache=", args.cache_dir)
 
-sys.exit(0)
+    sys.exit(0)
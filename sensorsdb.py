@@ -0,0 +1,506 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# sensorsdb - SQLite storage of the Voltcraft DL-120TH data.
+#
+# Copyright 2015 Patrick Rabu
+
+import calendar
+import os
+import sqlite3
+import time
+
+from collections import OrderedDict
+from itertools import islice
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS
+    sensors (logger text, dt integer, temp real, hygro real)''',
+    # Range queries of a logger are answered from the index only
+    '''CREATE INDEX IF NOT EXISTS
+    sensors_cover ON sensors (logger, dt, temp, hygro)''',
+    # Most recent dt stored for each logger
+    '''CREATE TABLE IF NOT EXISTS
+    watermarks (logger text PRIMARY KEY, dt integer)''',
+    # Alarms configured in each logger (NULL: none)
+    '''CREATE TABLE IF NOT EXISTS
+    alarms (logger text PRIMARY KEY, temp_low real, temp_high real,
+            hygro_low real, hygro_high real)''',
+    # Periods [dtmin, dtmax[ when the temp or the hygro of a logger was
+    # below (low) or above (high) its alarm, peak being its extremum
+    '''CREATE TABLE IF NOT EXISTS
+    excursions (logger text, dtmin integer, quantity text, kind text,
+                dtmax integer, peak real, threshold real,
+                PRIMARY KEY (logger, dtmin, quantity, kind))''')
+
+# Columns of the alarms table
+ALARMS = ('temp_low', 'temp_high', 'hygro_low', 'hygro_high')
+
+# Rollup tables: min / max / sum of the data of each logger per period
+# (seconds), dt being the start of the period
+ROLLUPS = (('sensors_hourly', 3600), ('sensors_daily', 86400))
+
+ROLLUP_SCHEMA = '''CREATE TABLE IF NOT EXISTS
+    %s (logger text, dt integer, count integer,
+        temp_min real, temp_max real, temp_sum real,
+        hygro_min real, hygro_max real, hygro_sum real,
+        PRIMARY KEY (logger, dt))'''
+
+# The hourly rollup is computed from the sensors table (or partition),
+# the coarser ones from the hourly rollup
+ROLLUP_FROM_SENSORS = '''INSERT OR REPLACE INTO %s
+    SELECT logger, dt / %i * %i, count(*),
+        min(temp), max(temp), sum(temp),
+        min(hygro), max(hygro), sum(hygro)
+    FROM %s
+    WHERE logger = ? AND dt >= ? AND dt < ?
+    GROUP BY logger, dt / %i'''
+
+ROLLUP_FROM_ROLLUP = '''INSERT OR REPLACE INTO %s
+    SELECT logger, dt / %i * %i, sum(count),
+        min(temp_min), max(temp_max), sum(temp_sum),
+        min(hygro_min), max(hygro_max), sum(hygro_sum)
+    FROM %s
+    WHERE logger = ? AND dt >= ? AND dt < ?
+    GROUP BY logger, dt / %i'''
+
+# Databases created by the first dat2db.py store dt as text: the table is
+# rebuilt with the epochs cast to integers (the indexes are created again
+# by SCHEMA and MIGRATE_UNIQUE)
+MIGRATE_INTEGER_DT = (
+    '''ALTER TABLE sensors RENAME TO sensors_text_dt''',
+    SCHEMA[0],
+    '''INSERT INTO sensors SELECT logger, CAST(dt AS INTEGER), temp, hygro
+    FROM sensors_text_dt''',
+    '''DROP TABLE sensors_text_dt''',
+    SCHEMA[1])
+
+# Databases created before the uniqueness constraint may hold duplicates
+MIGRATE_UNIQUE = (
+    '''DELETE FROM sensors WHERE rowid NOT IN
+    (SELECT min(rowid) FROM sensors GROUP BY logger, dt)''',
+    '''DROP INDEX IF EXISTS sensors_logger_dt''',
+    '''CREATE UNIQUE INDEX sensors_logger_dt ON sensors (logger, dt)''',
+    '''INSERT OR REPLACE INTO watermarks
+    SELECT logger, max(dt) FROM sensors GROUP BY logger''')
+
+# Most recent dt of a logger after an insert in a sensors table
+UPDATE_WATERMARK = '''INSERT OR REPLACE INTO watermarks
+    SELECT ?, max(dt) FROM
+    (SELECT dt FROM watermarks WHERE logger = ?
+     UNION ALL SELECT max(dt) FROM %s WHERE logger = ?)'''
+
+# Partitioned layout: the sensors rows are stored in one database file per
+# month or per year (UTC) next to the main one, which keeps the catalog of
+# the partitions, the watermarks and the rollups
+PARTITION_FORMATS = {'month': '%Y%m', 'year': '%Y'}
+
+CATALOG_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS partitioning (period text)''',
+    # Partition name (YYYYMM or YYYY), its range [dtmin, dtmax[ and its
+    # file relative to the main database
+    '''CREATE TABLE IF NOT EXISTS
+    partitions (name text PRIMARY KEY, dtmin integer, dtmax integer,
+                path text)''')
+
+PARTITION_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS
+    %s.sensors (logger text, dt integer, temp real, hygro real)''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS
+    %s.sensors_logger_dt ON sensors (logger, dt)''',
+    '''CREATE INDEX IF NOT EXISTS
+    %s.sensors_cover ON sensors (logger, dt, temp, hygro)''')
+
+# Number of partitions kept attached (SQLite attaches 10 at most)
+MAX_ATTACHED = 8
+
+
+class SensorsConnection(sqlite3.Connection):
+    """
+    Connection to a sensors database, knowing its partitioning: period is
+    None for a single sensors table, else 'month' or 'year'.
+    """
+    pass
+
+
+def connect(dbname, partition=None):
+    """
+    Open the database, creating the schema if missing.
+    Transactions are explicit (see insert_rows).
+    When partition ('month' or 'year') is given, the database is
+    partitioned (the rows of its sensors table being moved to the
+    partitions) unless it already is. The move of the rows is resumed if it
+    was interrupted.
+    """
+    conn = sqlite3.connect(dbname, isolation_level=None,
+                           factory=SensorsConnection)
+    conn.dbname = dbname
+    conn.attached = OrderedDict()
+    conn.period = None
+    create_schema(conn)
+
+    tables = set(row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    if 'partitioning' in tables:
+        conn.period = conn.execute(
+            'SELECT period FROM partitioning').fetchone()[0]
+        # Rows left in the sensors table by an interrupted move
+        if conn.execute('SELECT 1 FROM sensors LIMIT 1').fetchone():
+            move_to_partitions(conn)
+    elif partition is not None:
+        if partition not in PARTITION_FORMATS:
+            raise ValueError("Unknown partition period: %s" % partition)
+        conn.execute('BEGIN')
+        for stmt in CATALOG_SCHEMA:
+            conn.execute(stmt)
+        conn.execute('INSERT INTO partitioning VALUES (?)', (partition, ))
+        conn.execute('COMMIT')
+        conn.period = partition
+        move_to_partitions(conn)
+    return conn
+
+
+def create_schema(conn):
+    """
+    Create the tables and indexes if missing, migrating the sensors table
+    of the older databases (text dt, no uniqueness constraint).
+    """
+    for stmt in SCHEMA:
+        conn.execute(stmt)
+
+    columns = dict((row[1], row[2].lower())
+                   for row in conn.execute('PRAGMA table_info(sensors)'))
+    migrate_dt = columns['dt'] != 'integer'
+    indexes = dict((row[1], row[2])
+                   for row in conn.execute('PRAGMA index_list(sensors)'))
+    if migrate_dt or not indexes.get('sensors_logger_dt'):
+        conn.execute('BEGIN')
+        if migrate_dt:
+            for stmt in MIGRATE_INTEGER_DT:
+                conn.execute(stmt)
+        for stmt in MIGRATE_UNIQUE:
+            conn.execute(stmt)
+        conn.execute('COMMIT')
+    # The rollups of the migrated rows are computed again (the sensors
+    # table of a partitioned database is empty, its rollups are kept)
+    migrated = migrate_dt and conn.execute(
+        'SELECT 1 FROM sensors LIMIT 1').fetchone() is not None
+
+    tables = set(row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    missing = [table for table, period in ROLLUPS if table not in tables]
+    for table, period in ROLLUPS:
+        conn.execute(ROLLUP_SCHEMA % table)
+    if missing or migrated:
+        rebuild_rollups(conn)
+
+
+def update_rollups(conn, logger, dtmin, dtmax, sensors='sensors'):
+    """
+    Recompute the rollups of the periods of the logger holding data
+    between dtmin and dtmax (included), inside the current transaction.
+    sensors is the table holding the data (a partition may only hold the
+    data of whole days).
+    """
+    source = None
+    for table, period in ROLLUPS:
+        start = dtmin // period * period
+        end = (dtmax // period + 1) * period
+        if source is None:
+            stmt = ROLLUP_FROM_SENSORS % (table, period, period, sensors,
+                                          period)
+        else:
+            stmt = ROLLUP_FROM_ROLLUP % (table, period, period, source,
+                                         period)
+        conn.execute(stmt, (logger, start, end))
+        source = table
+
+
+def rebuild_rollups(conn):
+    """
+    Recompute all the rollups from the sensors table, or from each
+    partition in its own transaction.
+    """
+    partitioned = conn.period is not None
+    conn.execute('BEGIN')
+    for table, period in ROLLUPS:
+        conn.execute('DELETE FROM %s' % table)
+    if partitioned:
+        # The partitions are attached outside of a transaction
+        conn.execute('COMMIT')
+    for sensors in sensors_tables(conn):
+        if partitioned:
+            conn.execute('BEGIN')
+        for logger, dtmin, dtmax in conn.execute(
+                'SELECT logger, min(dt), max(dt) FROM %s GROUP BY logger'
+                % sensors).fetchall():
+            update_rollups(conn, logger, int(dtmin), int(dtmax), sensors)
+        if partitioned:
+            conn.execute('COMMIT')
+    if not partitioned:
+        conn.execute('COMMIT')
+
+
+def partition_range(period, dt):
+    """ Name and range [dtmin, dtmax[ of the partition holding dt. """
+    tm = time.gmtime(dt)
+    if period == 'month':
+        dtmin = calendar.timegm((tm.tm_year, tm.tm_mon, 1, 0, 0, 0))
+        year, month = divmod(tm.tm_mon, 12)
+        dtmax = calendar.timegm((tm.tm_year + year, month + 1, 1,
+                                 0, 0, 0))
+    else:
+        dtmin = calendar.timegm((tm.tm_year, 1, 1, 0, 0, 0))
+        dtmax = calendar.timegm((tm.tm_year + 1, 1, 1, 0, 0, 0))
+    return time.strftime(PARTITION_FORMATS[period], tm), dtmin, dtmax
+
+
+def attach_partition(conn, name, dtmin=None, dtmax=None):
+    """
+    Attach the partition name (outside of a transaction), creating it if
+    its range is given, and return its sensors table. The partitions
+    attached the longest ago are detached to stay under MAX_ATTACHED.
+    Return None if the partition does not exist.
+    """
+    schema = 'p' + name
+    if schema in conn.attached:
+        conn.attached[schema] = conn.attached.pop(schema)
+        return schema + '.sensors'
+
+    row = conn.execute('SELECT path FROM partitions WHERE name = ?',
+                       (name, )).fetchone()
+    if row is None and dtmin is None:
+        return None
+    if row is None:
+        path = os.path.splitext(os.path.basename(conn.dbname))[0] + \
+            '_' + name + '.db'
+    else:
+        path = row[0]
+
+    while len(conn.attached) >= MAX_ATTACHED:
+        conn.execute('DETACH DATABASE %s' % conn.attached.popitem(False)[0])
+    conn.execute('ATTACH DATABASE ? AS %s' % schema,
+                 (os.path.join(os.path.dirname(conn.dbname), path), ))
+    conn.attached[schema] = path
+
+    if row is None:
+        conn.execute('BEGIN')
+        for stmt in PARTITION_SCHEMA:
+            conn.execute(stmt % schema)
+        conn.execute('INSERT INTO partitions VALUES (?, ?, ?, ?)',
+                     (name, dtmin, dtmax, path))
+        conn.execute('COMMIT')
+    return schema + '.sensors'
+
+
+def sensors_tables(conn, dtmin=None, dtmax=None):
+    """
+    Generator of the sensors tables holding data between dtmin and dtmax
+    (excluded): the sensors table, or each overlapping partition, attached
+    while it is used.
+    """
+    if conn.period is None:
+        yield 'sensors'
+        return
+
+    stmt = 'SELECT name FROM partitions WHERE dtmax > ? AND dtmin < ?'
+    for row in conn.execute(stmt + ' ORDER BY dtmin', (
+            -2 ** 62 if dtmin is None else dtmin,
+            2 ** 62 if dtmax is None else dtmax)).fetchall():
+        yield attach_partition(conn, row[0])
+
+
+def partition_rows(conn, batch):
+    """
+    Split a batch of rows by partition, creating the missing ones.
+    Generator of the (sensors table, rows).
+    """
+    if conn.period is None:
+        yield 'sensors', batch
+        return
+
+    parts = OrderedDict()
+    dtmin = dtmax = None
+    for row in batch:
+        dt = int(row[1])
+        if dtmin is None or not dtmin <= dt < dtmax:
+            name, dtmin, dtmax = partition_range(conn.period, dt)
+            rows = parts.setdefault(name, (dtmin, dtmax, []))[2]
+        rows.append(row)
+
+    for name, (dtmin, dtmax, rows) in parts.items():
+        yield attach_partition(conn, name, dtmin, dtmax), rows
+
+
+def move_to_partitions(conn, batch_size=100000):
+    """
+    Move the rows of the sensors table of a newly partitioned database to
+    the partitions, then empty it and shrink the database file. The rows
+    already moved are ignored, so that an interrupted move can be run
+    again.
+    """
+    rowid = 0
+    while True:
+        batch = conn.execute('''SELECT rowid, logger, dt, temp, hygro
+            FROM sensors WHERE rowid > ? ORDER BY rowid LIMIT ?''',
+                             (rowid, batch_size)).fetchall()
+        if not batch:
+            break
+        rowid = batch[-1][0]
+        insert_rows(conn, iter([row[1:] for row in batch]), batch_size)
+    conn.execute('DELETE FROM sensors')
+    conn.execute('VACUUM')
+
+
+def get_watermark(conn, logger):
+    """ Most recent dt stored for the logger, None if none. """
+    row = conn.execute('SELECT dt FROM watermarks WHERE logger = ?',
+                       (logger, )).fetchone()
+    if row is None:
+        return None
+    return int(row[0])
+
+
+def get_loggers(conn):
+    """ Names of the loggers having data stored. """
+    return [row[0] for row in
+            conn.execute('SELECT logger FROM watermarks ORDER BY logger')]
+
+
+def get_alarms(conn, logger):
+    """ Dictionary of the alarms (see ALARMS) of the logger, None if none. """
+    row = conn.execute('SELECT %s FROM alarms WHERE logger = ?'
+                       % ', '.join(ALARMS), (logger, )).fetchone()
+    if row is None:
+        return None
+    return dict(zip(ALARMS, row))
+
+
+def set_alarms(conn, logger, alarms):
+    """ Store the dictionary of the alarms (see ALARMS) of the logger. """
+    conn.execute('BEGIN')
+    conn.execute('INSERT OR REPLACE INTO alarms VALUES (?, ?, ?, ?, ?)',
+                 (logger, ) + tuple(alarms.get(name) for name in ALARMS))
+    conn.execute('COMMIT')
+
+
+def store_excursions(conn, logger, dtmin, dtmax, excursions):
+    """
+    Replace the excursions of the logger starting between dtmin and dtmax
+    by the (quantity, kind, dtmin, dtmax, peak, threshold) excursions.
+    """
+    conn.execute('BEGIN')
+    conn.execute('''DELETE FROM excursions
+        WHERE logger = ? AND dtmin >= ? AND dtmin < ?''',
+                 (logger, dtmin, dtmax))
+    conn.executemany('''INSERT OR REPLACE INTO excursions
+        (logger, quantity, kind, dtmin, dtmax, peak, threshold)
+        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                     [(logger, ) + tuple(excursion)
+                      for excursion in excursions])
+    conn.execute('COMMIT')
+
+
+def get_excursions(conn, logger, dtmin=None, dtmax=None):
+    """
+    Stored excursions of the logger overlapping [dtmin, dtmax[ (all if not
+    given), as (quantity, kind, dtmin, dtmax, peak, threshold) by date.
+    """
+    return conn.execute('''SELECT quantity, kind, dtmin, dtmax, peak,
+        threshold FROM excursions
+        WHERE logger = ? AND dtmin < ? AND dtmax > ?
+        ORDER BY dtmin''', (logger, 2 ** 62 if dtmax is None else dtmax,
+                            -2 ** 62 if dtmin is None else dtmin)).fetchall()
+
+
+def skip_count(watermark, start, interval):
+    """
+    Number of leading samples of a recording starting at start (epoch)
+    every interval seconds that are not after the watermark.
+    """
+    if watermark is None or watermark < start:
+        return 0
+    return (watermark - start) // interval + 1
+
+
+def sample_rows(logger, start, interval, temp, rh, watermark=None):
+    """
+    Rows of a recording starting at start (epoch) every interval seconds,
+    temp and rh being in tenth of unit. The samples that are not after the
+    watermark are skipped.
+    Return the number of skipped samples and a generator of the
+    (logger, dt, temp, hygro) rows.
+    """
+    count = len(temp)
+    skipped = min(count, skip_count(watermark, start, interval))
+    temp = temp[skipped:].tolist()
+    rh = rh[skipped:].tolist()
+
+    def rows():
+        dt = start + skipped * interval
+        for i in range(len(temp)):
+            yield (logger, dt, temp[i] / 10.0, rh[i] / 10.0)
+            dt += interval
+
+    return skipped, rows()
+
+
+def set_pragmas(conn, journal_mode=None, synchronous=None, cache_size=None):
+    """ Tune the database connection for bulk inserts. """
+    if journal_mode is not None:
+        conn.execute('PRAGMA journal_mode = %s' % journal_mode)
+    if synchronous is not None:
+        conn.execute('PRAGMA synchronous = %s' % synchronous)
+    if cache_size is not None:
+        # Negative value: size in KiB instead of pages
+        conn.execute('PRAGMA cache_size = %i' % -cache_size)
+
+
+def insert_rows(conn, rows, batch_size=10000, progress=None):
+    """
+    Insert the (logger, dt, temp, hygro) rows in the sensors table (or in
+    their partitions) by batches of batch_size rows, each batch (or part
+    of a batch in a partition) in its own transaction.
+    Rows already stored are ignored, the watermarks and the rollups are
+    updated.
+    Print the number of processed rows every progress rows if given.
+    Return the number of processed rows and the number of new rows.
+    """
+    count = 0
+    new = 0
+    next_progress = progress
+    c = conn.cursor()
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+
+        for sensors, rows_part in partition_rows(conn, batch):
+            c.execute('BEGIN')
+            try:
+                changes = conn.total_changes
+                c.executemany('INSERT OR IGNORE INTO %s VALUES (?, ?, ?, ?)'
+                              % sensors, rows_part)
+                inserted = conn.total_changes - changes
+                ranges = {}
+                for row in rows_part:
+                    dt = int(row[1])
+                    dtmin, dtmax = ranges.get(row[0], (dt, dt))
+                    ranges[row[0]] = (min(dtmin, dt), max(dtmax, dt))
+                for logger, (dtmin, dtmax) in ranges.items():
+                    c.execute(UPDATE_WATERMARK % sensors,
+                              (logger, logger, logger))
+                    update_rollups(conn, logger, dtmin, dtmax, sensors)
+                c.execute('COMMIT')
+            except BaseException:
+                # Leave no transaction open for the next batches
+                c.execute('ROLLBACK')
+                raise
+            new += inserted
+        count += len(batch)
+
+        if progress and count >= next_progress:
+            print("Rows processed:", count)
+            next_progress += progress
+
+    return count, new
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# test_dbquery - Tests of the statistics of the sensors database
+#
+# Copyright 2015 Patrick Rabu
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from array import array
+
+import dbquery
+import sensorsdb
+
+# One sample every 10 minutes during 2014
+START = 1388534400
+INTERVAL = 600
+COUNT = 365 * 144
+
+
+class DbQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tz = os.environ.get('TZ')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        if self.tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def database(self, partition=None, count=COUNT):
+        conn = sensorsdb.connect(os.path.join(self.tmpdir, 'sensors.db'),
+                                 partition)
+        temp = array('h', [150 + i % 100 for i in range(count)])
+        rh = array('h', [500 + i % 50 for i in range(count)])
+        skipped, rows = sensorsdb.sample_rows('rdc', START, INTERVAL, temp,
+                                              rh)
+        sensorsdb.insert_rows(conn, rows, 100000)
+        return conn
+
+    def test_stats_partitions(self):
+        conn = self.database('month')
+        # Edges not aligned on the rollups: more partitions than attached
+        edges = dbquery.bucket_edges('month', START + 1800,
+                                     START + COUNT * INTERVAL - 1800)
+        dbquery.create_buckets(conn, edges)
+        stats = dbquery.sql_stats(conn, 'rdc', edges)
+        self.assertEqual(len(stats), len(edges) - 1)
+        self.assertEqual(sum(row[1] for row in stats), COUNT - 6)
+        self.assertEqual([row[1:] for row in stats],
+                         [row[1:8] for row in dbquery.numpy_stats(
+                             conn, 'rdc', edges, [], [])])
+        conn.close()
+
+    def test_stats_local_time(self):
+        conn = self.database()
+        os.environ['TZ'] = 'Europe/Paris'
+        time.tzset()
+        # -m 201403 -g day: the 30th lasts 23 hours, the days start at
+        # 23:00 or 22:00 UTC (from the hourly rollup)
+        tmin, tmax = dbquery.period_range('201403')
+        edges = dbquery.bucket_edges('day', tmin, tmax)
+        self.assertEqual(len(edges), 32)
+        self.assertEqual(set(time.localtime(edge)[3:6] for edge in edges),
+                         set([(0, 0, 0)]))
+        dbquery.create_buckets(conn, edges)
+        stats = dbquery.sql_stats(conn, 'rdc', edges)
+        self.assertEqual([row[1] for row in stats],
+                         [144] * 29 + [138, 144])
+        self.assertEqual([row[1:] for row in stats],
+                         [row[1:8] for row in dbquery.numpy_stats(
+                             conn, 'rdc', edges, [], [])])
+
+        # Hours of a time zone 30 minutes off UTC (from the sensors table)
+        os.environ['TZ'] = 'Asia/Kolkata'
+        time.tzset()
+        edges = dbquery.bucket_edges('hour', START, START + 86400)
+        self.assertEqual(len(edges), 26)
+        self.assertEqual(set(time.localtime(edge)[4:6]
+                             for edge in edges[1:-1]), set([(0, 0)]))
+        dbquery.create_buckets(conn, edges)
+        stats = dbquery.sql_stats(conn, 'rdc', edges)
+        self.assertEqual([row[1] for row in stats], [3] + [6] * 23 + [3])
+        conn.close()
+
+    def test_excursions_thresholds(self):
+        conn = self.database(count=1000)
+        sensorsdb.set_alarms(conn, 'rdc', {'temp_high': 24.0})
+        tmin, tmax = START, START + 1000 * INTERVAL
+        scanned = list(dbquery.iter_excursions(conn, ['rdc'], tmin, tmax,
+                                               {}))
+        self.assertEqual(len(scanned[0]), 10)
+        self.assertEqual(len(sensorsdb.get_excursions(conn, 'rdc')), 10)
+
+        # Other thresholds: reported, the stored excursions are kept
+        other = list(dbquery.iter_excursions(conn, ['rdc'], tmin, tmax,
+                                             {'temp_high': 20.0}))
+        self.assertEqual(len(other[0]), 10)
+        self.assertEqual(set(row[8] for row in other[0]), set([20.0]))
+        self.assertEqual(set(excursion[5] for excursion in
+                             sensorsdb.get_excursions(conn, 'rdc')),
+                         set([24.0]))
+        self.assertEqual(list(dbquery.iter_excursions(
+            conn, ['rdc'], tmin, tmax, {}, True)), scanned)
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
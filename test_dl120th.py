@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+#
+# test_dl120th - Tests of dl-120th.py against an emulated DL-120TH
+#
+# Copyright 2015 Patrick Rabu
+
+import imp
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from datetime import timedelta
+from io import BytesIO
+
+from dl120emu import Dl120thEmulator
+
+
+DL120TH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'dl-120th.py')
+
+
+def load_dl120th():
+    """ Load dl-120th.py as a module (its file name is not importable). """
+    return imp.load_source('dl120th', DL120TH)
+
+
+dl120th = load_dl120th()
+
+
+class Output:
+    """ Capture the output printed while it is active. """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = self.buf = BytesIO()
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.stdout = self.stdout
+
+    def lines(self):
+        return self.buf.getvalue().splitlines()
+
+
+def dat_lines(device):
+    """ Lines of the dat file of the recording of an emulated logger. """
+    lines = ["# %s [%s] %i points @ %i sec" % (
+        device.name, device.start.strftime("%Y-%m-%d %H:%M:%S"),
+        device.num_data_rec, device.interval)]
+    temp, rh = dl120th.decode_samples(device.data, device.num_data_rec)
+    for i in range(device.num_data_rec):
+        dt = device.start + timedelta(seconds=i * device.interval)
+        lines.append(" ".join((dt.strftime("%s"),
+                               dt.strftime("%Y-%m-%d %H:%M:%S"),
+                               str(temp[i] / 10.0), str(rh[i] / 10.0))))
+    return lines
+
+
+class BrokenEmulator(Dl120thEmulator):
+    """ Emulated logger that can't be opened. """
+    def open(self):
+        raise dl120th.usb.USBError("Emulated open failure")
+
+
+class Dl120thTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def open_logger(self, device, **kwargs):
+        logger = dl120th.Dl120th(device, backoff=0, **kwargs)
+        with Output():
+            dl120th.open_logger(logger)
+        return logger
+
+    def test_read_config(self):
+        device = Dl120thEmulator.synthetic(1000, interval=10)
+        logger = self.open_logger(device)
+        self.assertEqual(logger.logger_name, 'emulated')
+        self.assertEqual(logger.num_data_rec, 1000)
+        self.assertEqual(logger.interval, 10)
+        self.assertEqual(logger.start_rec, device.start)
+        self.assertEqual(logger.alarms()['temp_high'], 40)
+
+    def test_save(self):
+        device = Dl120thEmulator.synthetic(5000)
+        logger = self.open_logger(device)
+        fn = os.path.join(self.tmpdir, 'emulated.dat')
+        with Output():
+            logger.read_data()
+            logger.save_data_to_file(fn)
+        with open(fn) as datfile:
+            self.assertEqual(datfile.read().splitlines(), dat_lines(device))
+
+    def test_print(self):
+        device = Dl120thEmulator.synthetic(100)
+        logger = self.open_logger(device)
+        with Output() as output:
+            logger.print_data()
+        lines = dat_lines(device)[1:]
+        printed = output.lines()
+        for i, line in enumerate(lines):
+            epoch, date, clock, temp, rh = line.split()
+            self.assertEqual(printed[i], str((i, date + " " + clock, epoch,
+                                              float(temp), float(rh))))
+        self.assertEqual(printed[len(lines)], str(("Excursions:", 0)))
+
+    def test_retry(self):
+        device = Dl120thEmulator.synthetic(3000)
+        device.faults = set([10, 64, 150])
+        logger = self.open_logger(device)
+        with Output() as output:
+            logger.read_data()
+        self.assertEqual(logger.retry_count, 3)
+        self.assertEqual(logger.metrics.counters['retries'], 3)
+        self.assertEqual(len([line for line in output.lines()
+                              if "Transfer error" in line]), 3)
+        temp, rh = dl120th.decode_samples(device.data, 3000)
+        self.assertEqual(list(logger.temp.raw), list(temp))
+        self.assertEqual(list(logger.rh.raw), list(rh))
+
+    def test_retries_exhausted(self):
+        device = Dl120thEmulator.synthetic(3000)
+        device.faults = set([10])
+        logger = self.open_logger(device, retries=0)
+        with Output():
+            self.assertRaises(IOError, logger.read_data)
+        self.assertEqual(logger.retry_count, 0)
+        self.assertEqual(logger.temp, None)
+
+    def test_open_error(self):
+        logger = dl120th.Dl120th(BrokenEmulator.synthetic(100))
+        self.assertRaises(dl120th.usb.USBError, logger.open)
+        logger = dl120th.Dl120th(None)
+        self.assertRaises(IOError, logger.open)
+
+    def test_open_loggers_error(self):
+        loggers = [dl120th.Dl120th(Dl120thEmulator.synthetic(100)),
+                   dl120th.Dl120th(BrokenEmulator.synthetic(100))]
+        with Output():
+            self.assertRaises(dl120th.usb.USBError, dl120th.open_loggers,
+                              loggers)
+        # The logger opened is released
+        self.assertEqual([logger.handle for logger in loggers],
+                         [None, None])
+        self.assertTrue('close' in loggers[0].metrics.phases)
+
+    def test_command_line(self):
+        fn = os.path.join(self.tmpdir, 'emulated.dat')
+        for args in (['-c', 'info', '-e', '100', '--verbose'],
+                     ['-c', 'save', '-e', '100', '-o', fn]):
+            process = subprocess.Popen([sys.executable, DL120TH] + args,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+            self.assertEqual(process.returncode, 0, output)
+            self.assertTrue(b'"logger": "emulated"' in output, output)
+        with open(fn) as datfile:
+            self.assertEqual(len(datfile.read().splitlines()), 101)
+
+    def test_pipeline(self):
+        device = Dl120thEmulator.synthetic(5000)
+        logger = self.open_logger(device)
+        fn = os.path.join(self.tmpdir, 'emulated.dat')
+        with Output():
+            logger.download([dl120th.DatSink(fn, logger)], 4, 3)
+        with open(fn) as datfile:
+            self.assertEqual(datfile.read().splitlines(), dat_lines(device))
+
+    def test_pipeline_stopped(self):
+        threads = threading.active_count()
+        device = Dl120thEmulator.synthetic(5000)
+        logger = self.open_logger(device)
+        chunks = logger.iter_chunks(2, 1)
+        self.assertEqual(next(chunks)[0], 0)
+        chunks.close()
+        # The reader thread blocked on the full queue is stopped
+        self.assertEqual(threading.active_count(), threads)
+
+        class FailingSink:
+            def write(self, first, temp, rh):
+                raise ValueError("Sink error")
+
+            def close(self):
+                pass
+
+        logger = self.open_logger(device)
+        self.assertRaises(ValueError, logger.download, [FailingSink()], 2, 1)
+        self.assertEqual(threading.active_count(), threads)
+
+        # The error of the reader is reported when the consumer stops first
+        device.faults = set([5])
+        logger = self.open_logger(device, retries=0)
+        with Output() as output:
+            chunks = logger.iter_chunks(100, 1)
+            next(chunks)
+            time.sleep(0.1)
+            chunks.close()
+        self.assertEqual(threading.active_count(), threads)
+        self.assertTrue(any("Download stopped" in line
+                            for line in output.lines()))
+
+
+class CollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, 'sensors.db')
+        self.devices = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def collector(self, **kwargs):
+        return dl120th.Collector(
+            lambda: self.devices, self.db,
+            new_logger=lambda address, device: dl120th.Dl120th(
+                device, backoff=0, address=address), **kwargs)
+
+    def downloads(self, collector):
+        """ Scan and poll once, return the number of downloads. """
+        with Output() as output:
+            collector.poll_all()
+        return len([line for line in output.lines()
+                    if "download of" in line])
+
+    def test_full_logger_downloaded_once(self):
+        device = Dl120thEmulator.synthetic(2000)
+        device.num_data_conf = 2000
+        self.devices.append(('emu:0', device))
+        collector = self.collector(every=0)
+        self.assertEqual(self.downloads(collector), 1)
+        self.assertEqual(self.downloads(collector), 0)
+
+        # New recording
+        device.start += timedelta(days=1)
+        self.assertEqual(self.downloads(collector), 1)
+        self.assertEqual(self.downloads(collector), 0)
+
+    def test_rearm(self):
+        device = Dl120thEmulator.synthetic(2000)
+        device.num_data_conf = 2000
+        self.devices.append(('emu:0', device))
+        collector = self.collector(rearm=True)
+        self.assertEqual(self.downloads(collector), 1)
+        self.assertEqual(device.num_data_rec, 0)
+        device.set_recording([200] * 2000, [500] * 2000)
+        self.assertEqual(self.downloads(collector), 1)
+
+    def test_failing_loggers_dropped(self):
+        self.devices.append(('emu:0', BrokenEmulator.synthetic(100)))
+        device = Dl120thEmulator.synthetic(2000)
+        device.num_data_conf = 2000
+        self.devices.append(('emu:1', device))
+        collector = self.collector()
+        self.assertEqual(self.downloads(collector), 1)
+        self.assertEqual(list(collector.loggers), ['emu:1'])
+
+        # Database error: the logger is released, then opened again
+        device.start += timedelta(days=1)
+        collector.database = os.path.join(self.tmpdir, 'missing', 'db')
+        with Output() as output:
+            collector.poll_all()
+        self.assertEqual(collector.loggers, {})
+        self.assertTrue(any("emu:1" in line and "error:" in line
+                            for line in output.lines()))
+        collector.database = self.db
+        self.assertEqual(self.downloads(collector), 1)
+
+    def test_metrics(self):
+        device = Dl120thEmulator.synthetic(2000)
+        device.num_data_conf = 2000
+        self.devices.append(('emu:0', device))
+        prom = os.path.join(self.tmpdir, 'dl120th.prom')
+        collector = self.collector(metrics_file=prom)
+        with Output() as output:
+            collector.poll_all()
+        # Only the download reports are printed
+        lines = [line for line in output.lines()
+                 if line.startswith('{')]
+        self.assertEqual(len(lines), 1)
+        self.assertFalse(any("Config" in line for line in output.lines()))
+        summary = json.loads(lines[0])
+        self.assertEqual(summary['packets'], 125)
+        self.assertEqual(summary['logger'], 'emulated')
+        with open(prom) as textfile:
+            text = textfile.read()
+        self.assertTrue("# TYPE dl120th_packets_total counter\n" in text)
+        self.assertTrue('dl120th_packets_total{address="emu:0",'
+                        'logger="emulated"} 125.0\n' in text)
+
+
+if __name__ == '__main__':
+    unittest.main()
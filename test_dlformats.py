@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# test_dlformats - Tests of the file formats of the DL-120TH data
+#
+# Copyright 2015 Patrick Rabu
+
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+from array import array
+from datetime import datetime, timedelta
+
+import dlformats
+
+# Starts of the recordings: daylight saving time changes of 30 minutes
+# (Lord Howe Island), and of one hour at 2:45 (Chatham Islands)
+DST_CHANGES = (('Australia/Lord_Howe', datetime(2015, 4, 4, 22, 0, 0)),
+               ('Australia/Lord_Howe', datetime(2015, 10, 3, 22, 0, 0)),
+               ('Pacific/Chatham', datetime(2015, 4, 4, 22, 0, 0)),
+               ('Pacific/Chatham', datetime(2015, 9, 26, 22, 0, 0)),
+               ('Europe/Paris', datetime(2015, 3, 28, 22, 0, 0)),
+               ('Europe/Paris', datetime(2015, 10, 24, 22, 0, 0)))
+
+
+class DatTimestampsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tz = os.environ.get('TZ')
+
+    def tearDown(self):
+        if self.tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def test_dst_changes(self):
+        for tz, start in DST_CHANGES:
+            os.environ['TZ'] = tz
+            time.tzset()
+            for interval in (2, 7, 60, 3600):
+                count = min(10000, 8 * 3600 // interval)
+                epochs, datetimes = dlformats.dat_timestamps(start, interval,
+                                                             count)
+                for i in range(count):
+                    dt = start + timedelta(seconds=i * interval)
+                    self.assertEqual(
+                        (epochs[i], datetimes[i]),
+                        (dt.strftime("%s"),
+                         dt.strftime("%Y-%m-%d %H:%M:%S")),
+                        "%s %s @ %i s" % (tz, dt, interval))
+
+
+def samples(count, seed=0):
+    """
+    temp and rh (array('h')) of count samples: the int16 extremes, the
+    largest deltas, then random values.
+    """
+    extremes = [-32768, 32767, -32768, 0, 32767, -1, 1, -32768]
+    rand = random.Random(seed)
+    values = (extremes + [rand.randint(-32768, 32767)
+                          for i in range(count)])[:count]
+    return array('h', values), array('h', reversed(values))
+
+
+class DlaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.numpy = dlformats.numpy
+        self.tz = os.environ.get('TZ')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        dlformats.numpy = self.numpy
+        if self.tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def read(self, fn):
+        with open(fn, 'rb') as dlafile:
+            return dlafile.read()
+
+    def test_numpy_and_python(self):
+        if self.numpy is None:
+            self.skipTest("numpy is not installed")
+        temp, rh = samples(10000)
+        files = []
+        for numpy in (self.numpy, None):
+            dlformats.numpy = numpy
+            fn = os.path.join(self.tmpdir, '%s.dla' % (numpy is None))
+            dlformats.write_dla(fn, 'rdc', 1420070400, 60, 10000, temp, rh)
+            files.append(fn)
+        # Same bytes, decoded the same by both paths
+        self.assertEqual(self.read(files[0]), self.read(files[1]))
+        for numpy in (self.numpy, None):
+            dlformats.numpy = numpy
+            recording = dlformats.load_dla(files[0])
+            self.assertEqual(list(recording.temp.raw), list(temp))
+            self.assertEqual(list(recording.rh.raw), list(rh))
+
+    def test_blocks(self):
+        count = 3 * dlformats.DLA_BLOCK_SIZE + 100
+        temp, rh = samples(count)
+        fn = os.path.join(self.tmpdir, 'rdc.dla')
+        dlformats.write_dla(fn, 'rdc', 1420070400, 60, count, temp, rh)
+        recording = dlformats.load_dla(fn)
+        self.assertEqual(recording.count, count)
+        self.assertEqual(list(recording.temp.raw), list(temp))
+        self.assertEqual(list(recording.rh.raw), list(rh))
+
+        # Range read: the first two blocks are skipped without being
+        # decompressed (the first one is corrupted)
+        with open(fn, 'r+b') as dlafile:
+            dlafile.seek(dlformats.DLA_HEADER.size + dlformats.DLA_BLOCK.size)
+            dlafile.write(b'\0' * 16)
+        skip = 2 * dlformats.DLA_BLOCK_SIZE + 10
+        with dlformats.DlaReader(fn) as reader:
+            blocks = list(reader.blocks(skip))
+        self.assertEqual([block[0] for block in blocks],
+                         [2 * dlformats.DLA_BLOCK_SIZE,
+                          3 * dlformats.DLA_BLOCK_SIZE])
+        first, block_temp, block_rh = blocks[0]
+        self.assertEqual(list(block_temp),
+                         list(temp[first:first + len(block_temp)]))
+        self.assertEqual(list(blocks[1][2]), list(rh[blocks[1][0]:]))
+
+    def test_dat_round_trip(self):
+        # Several blocks across a daylight saving time change
+        os.environ['TZ'] = 'Europe/Paris'
+        time.tzset()
+        count = 3 * dlformats.DLA_BLOCK_SIZE + 100
+        temp, rh = samples(count)
+        dat = os.path.join(self.tmpdir, 'rdc.dat')
+        dla = os.path.join(self.tmpdir, 'rdc.dla')
+        converted = os.path.join(self.tmpdir, 'converted.dat')
+        dlformats.write_dat(dat, 'rdc', datetime(2015, 3, 25), 60, count,
+                            temp, rh)
+        self.assertEqual(dlformats.dat_to_dla(dat, dla), count)
+        self.assertEqual(dlformats.dla_to_dat(dla, converted), count)
+        self.assertEqual(self.read(converted), self.read(dat))
+
+
+if __name__ == '__main__':
+    unittest.main()
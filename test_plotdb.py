@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# test_plotdb - Tests of the plots of the sensors database
+#
+# Copyright 2015 Patrick Rabu
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+from array import array
+
+import plotdb
+import sensorsdb
+
+# 2015-01-01 00:00:00 UTC
+START = 1420070400
+
+
+class PlotDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, 'sensors.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def insert(self, start, interval, count):
+        conn = sensorsdb.connect(self.db)
+        temp = array('h', [150 + i % 100 for i in range(count)])
+        rh = array('h', [500 + i % 50 for i in range(count)])
+        skipped, rows = sensorsdb.sample_rows('rdc', start, interval, temp,
+                                              rh)
+        sensorsdb.insert_rows(conn, rows)
+        conn.close()
+
+    def test_load_month(self):
+        dtmin, dtmax = plotdb.month_range('201501')
+        tmin = int(dtmin.strftime("%s"))
+        # A sample every 10 minutes, the temperature missing for an hour
+        rows = [('rdc', tmin + 600 * i, None if 12 <= i < 18 else i / 10.0,
+                 50.0 + i % 2) for i in range(31 * 144)]
+        conn = sensorsdb.connect(self.db)
+        sensorsdb.insert_rows(conn, iter(rows))
+        conn.close()
+
+        series, = plotdb.load_db(self.db, dtmin, dtmax, 0)
+        self.assertEqual(list(series.dates), [row[1] for row in rows])
+        self.assertEqual(list(series.hygro), [row[3] for row in rows])
+        self.assertEqual([None if math.isnan(temp) else temp
+                          for temp in series.temp],
+                         [row[2] for row in rows])
+
+        # One bucket per hour (from the hourly rollup) or per 20 minutes
+        for points, size in ((31 * 24, 6), (31 * 72, 2)):
+            series, = plotdb.load_db(self.db, dtmin, dtmax, points)
+            self.assertEqual(len(series.dates), points)
+            self.assertEqual(series.dates[3], tmin + 3 * size * 600)
+            self.assertEqual(series.hygro_min[3], 50.0)
+            self.assertEqual(series.hygro_max[3], 51.0)
+            temp = [row[2] for row in rows[3 * size:4 * size]]
+            self.assertAlmostEqual(series.temp[3], sum(temp) / size)
+            self.assertEqual(series.temp_min[3], min(temp))
+            self.assertEqual(series.temp_max[3], max(temp))
+            # Bucket without temperature
+            bucket = 12 // size
+            self.assertTrue(math.isnan(series.temp[bucket]))
+            self.assertTrue(math.isnan(series.temp_min[bucket]))
+            self.assertTrue(math.isnan(series.temp_max[bucket]))
+            self.assertEqual(series.hygro_max[bucket], 51.0)
+
+    def plot_months(self, months):
+        return sorted(os.path.basename(output) for output, rendered in
+                      plotdb.plot_months(self.db, months, self.tmpdir, 100,
+                                         None, 1))
+
+    def test_plot_months_changed(self):
+        # Two days of data in January, two days at the middle of February
+        self.insert(START, 600, 288)
+        self.insert(START + 45 * 86400, 600, 288)
+        months = ['201501', '201502']
+        self.assertEqual(self.plot_months(months),
+                         ['201501.png', '201502.png'])
+        self.assertEqual(self.plot_months(months), [])
+
+        # New data in January only
+        self.insert(START + 2 * 86400, 600, 144)
+        self.assertEqual(self.plot_months(months), ['201501.png'])
+        self.assertEqual(self.plot_months(months), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# test_sensorsdb - Tests of the SQLite storage of the DL-120TH data
+#
+# Copyright 2015 Patrick Rabu
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from array import array
+
+import sensorsdb
+
+
+class SensorsDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, 'sensors.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_migrate_text_dt(self):
+        # Database of the first dat2db.py: text dt, duplicates
+        conn = sqlite3.connect(self.db)
+        conn.execute('''CREATE TABLE
+            sensors (logger text, dt text, temp real, hygro real)''')
+        rows = [('rdc', str(1420070400 + 2 * i), '20.5', '55.0')
+                for i in range(100)]
+        conn.executemany('INSERT INTO sensors VALUES (?, ?, ?, ?)',
+                         rows + rows[:10])
+        conn.commit()
+        conn.close()
+
+        conn = sensorsdb.connect(self.db)
+        self.assertEqual(conn.execute(
+            'SELECT DISTINCT typeof(dt) FROM sensors').fetchall(),
+            [('integer', )])
+        self.assertEqual(conn.execute(
+            'SELECT count(*), min(dt), max(dt) FROM sensors').fetchone(),
+            (100, 1420070400, 1420070598))
+        self.assertEqual(sensorsdb.get_watermark(conn, 'rdc'), 1420070598)
+        self.assertEqual(conn.execute(
+            'SELECT sum(count) FROM sensors_daily').fetchone()[0], 100)
+
+        # The samples already stored are skipped
+        skipped, rows = sensorsdb.sample_rows(
+            'rdc', 1420070400, 2, array('h', [205] * 150),
+            array('h', [550] * 150), sensorsdb.get_watermark(conn, 'rdc'))
+        self.assertEqual(skipped, 100)
+        self.assertEqual(sensorsdb.insert_rows(conn, rows), (50, 50))
+        self.assertEqual(sensorsdb.get_watermark(conn, 'rdc'), 1420070698)
+        conn.close()
+
+    def test_failed_batch(self):
+        conn = sensorsdb.connect(self.db)
+        rows = [('rdc', 1420070400 + 2 * i, 20.5, 55.0) for i in range(10)]
+        self.assertRaises(sqlite3.Error, sensorsdb.insert_rows, conn,
+                          iter(rows[:5] + [('rdc', 1420070500)]))
+        # The failed batch is rolled back, with its watermark
+        self.assertEqual(sensorsdb.get_watermark(conn, 'rdc'), None)
+        self.assertEqual(sensorsdb.insert_rows(conn, iter(rows)), (10, 10))
+        self.assertEqual(sensorsdb.get_watermark(conn, 'rdc'), 1420070418)
+        conn.close()
+
+    def test_interrupted_partitioning(self):
+        conn = sensorsdb.connect(self.db)
+        rows = [('rdc', 1420070400 + 8000 * i, 20.5, 55.0)
+                for i in range(1000)]
+        sensorsdb.insert_rows(conn, iter(rows))
+        # Crash while moving the rows: the database is partitioned, the
+        # first rows are in their partition and all of them in sensors
+        conn.execute('BEGIN')
+        for stmt in sensorsdb.CATALOG_SCHEMA:
+            conn.execute(stmt)
+        conn.execute("INSERT INTO partitioning VALUES ('month')")
+        conn.execute('COMMIT')
+        conn.period = 'month'
+        sensorsdb.insert_rows(conn, iter(rows[:300]))
+        conn.close()
+
+        conn = sensorsdb.connect(self.db)
+        self.assertEqual(conn.execute(
+            'SELECT count(*) FROM main.sensors').fetchone()[0], 0)
+        self.assertEqual(sum(conn.execute(
+            'SELECT count(*) FROM %s' % table).fetchone()[0]
+            for table in sensorsdb.sensors_tables(conn)), 1000)
+        self.assertEqual(conn.execute(
+            'SELECT sum(count) FROM sensors_daily').fetchone()[0], 1000)
+        self.assertEqual(sensorsdb.get_watermark(conn, 'rdc'), rows[-1][1])
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()